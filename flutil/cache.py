@@ -0,0 +1,207 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def estimate_size(value):
+    """
+    Rough estimate of the memory held by a value, looking inside the
+    containers typically returned by a query (lists of tuples or dicts).
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        items = value.items()
+        size += sum(sys.getsizeof(k) + estimate_size(v) for k, v in items)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(v) for v in value)
+    return size
+
+
+class _Entry(object):
+    __slots__ = ('value', 'size', 'expires_at', 'tags')
+
+    def __init__(self, value, size, expires_at, tags):
+        self.value = value
+        self.size = size
+        self.expires_at = expires_at
+        self.tags = tags
+
+
+class _Flight(object):
+    """
+    A load in progress that concurrent misses for the same key wait on.
+    """
+    __slots__ = ('event', 'value', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class LRUCache(object):
+    """
+    Thread-safe in-process cache with per-entry TTLs, bounded both by number
+    of entries and by estimated bytes, evicting the least recently used
+    entries first. Entries can be tagged and invalidated by tag.
+
+    - max_entries is the maximum number of entries to keep
+    - max_bytes is the maximum estimated size of all values, None for no limit
+    - sizeof is the function used to estimate the size of a value
+
+    Cached values are shared between callers and must be treated as read-only.
+
+    """
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024, sizeof=estimate_size):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._flights = {}
+        self._generation = 0
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, key, now):
+        # Must be called with the lock held.
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        if entry.expires_at is not None and entry.expires_at <= now:
+            self._forget(key, entry)
+            return None
+        # Re-insert to mark as most recently used.
+        self._entries[key] = entry
+        return entry
+
+    def _forget(self, key, entry):
+        # Must be called with the lock held, after the entry has been popped.
+        self._bytes -= entry.size
+        for tag in entry.tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._lookup(key, time.time())
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry.value
+
+    def set(self, key, value, ttl=None, tags=()):
+        """
+        Store value under key for ttl seconds (forever if None).
+        """
+        entry = self._entry(value, ttl, tags)
+        if entry is None:
+            return
+        with self._lock:
+            self._set_locked(key, entry)
+
+    def _entry(self, value, ttl, tags):
+        # Sized outside the lock; None if the value is too big to cache.
+        size = self._sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return None
+        expires_at = time.time() + ttl if ttl is not None else None
+        return _Entry(value, size, expires_at, frozenset(tags))
+
+    def _set_locked(self, key, entry):
+        # Must be called with the lock held.
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._forget(key, old)
+        self._entries[key] = entry
+        self._bytes += entry.size
+        for tag in entry.tags:
+            self._tags.setdefault(tag, set()).add(key)
+        self._evict()
+
+    def _evict(self):
+        # Must be called with the lock held.
+        while self._entries and (len(self._entries) > self.max_entries or
+                                 (self.max_bytes is not None and self._bytes > self.max_bytes)):
+            key, entry = self._entries.popitem(last=False)
+            self._forget(key, entry)
+            self.evictions += 1
+
+    def get_or_load(self, key, loader, ttl=None, tags=()):
+        """
+        Return the cached value for key, calling loader() to fill it on a miss.
+        Concurrent misses for the same key share a single call to loader.
+        """
+        with self._lock:
+            entry = self._lookup(key, time.time())
+            if entry is not None:
+                self.hits += 1
+                return entry.value
+            self.misses += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            generation = self._generation
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        entry = None
+        try:
+            flight.value = loader()
+            entry = self._entry(flight.value, ttl, tags)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                # Don't cache a value that may predate an invalidation made while it loaded.
+                if entry is not None and generation == self._generation:
+                    self._set_locked(key, entry)
+                del self._flights[key]
+            flight.event.set()
+        return flight.value
+
+    def invalidate(self, *tags):
+        """
+        Drop every entry carrying any of the given tags.
+        """
+        with self._lock:
+            self._generation += 1
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    entry = self._entries.pop(key, None)
+                    if entry is not None:
+                        self._forget(key, entry)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._tags.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -1,18 +1,152 @@
+import atexit
+import binascii
+import io
+import json
 import os
+import itertools
 import logging
+import re
+import resource
+import select
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
 from contextlib import contextmanager
+from datetime import date, datetime, time as dt_time, timedelta
+from decimal import Decimal
+from uuid import UUID
 
 import psycopg2
 from psycopg2 import pool
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import Json, RealDictCursor, NamedTupleCursor
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from flutil.cache import LRUCache
 
 MAX_CONNECTION_ATTEMPTS = 10
 
+ROW_FORMATS = {
+    'tuple': psycopg2.extensions.cursor,
+    'dict': RealDictCursor,
+    'namedtuple': NamedTupleCursor,
+}
+
+_stream_ids = itertools.count()
+_statement_ids = itertools.count()
+
+_PLACEHOLDER = re.compile(r'%(?:\((\w+)\))?s|%%')
+
+# Statements PREPARE accepts. Anything else (DDL, SET, SHOW, several statements
+# at once) is always executed as is.
+_PREPARABLE = re.compile(r'\s*(SELECT|INSERT|UPDATE|DELETE|VALUES|WITH)\b', re.IGNORECASE)
+
+# Stop tracking query frequencies once this many distinct queries have been seen.
+MAX_TRACKED_STATEMENTS = 10000
+
+# Reports how far behind the primary a replica is, in seconds. PostgreSQL 10
+# renamed the xlog functions; REPLICATION_LAG_QUERY_9 is for older servers.
+REPLICATION_LAG_QUERY = (
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END AS lag;"
+)
+REPLICATION_LAG_QUERY_9 = (
+    "SELECT CASE WHEN pg_last_xlog_receive_location() = pg_last_xlog_replay_location() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END AS lag;"
+)
+
+# Upper bounds, in milliseconds, of the checkout wait time histogram buckets.
+CHECKOUT_WAIT_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+_CHECKOUT_WAIT_LABELS = ['le_%dms' % bound for bound in CHECKOUT_WAIT_BUCKETS_MS] + \
+    ['gt_%dms' % CHECKOUT_WAIT_BUCKETS_MS[-1]]
+
+_COPY_ESCAPES = (('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r'))
+
+
+def _quote_ident(name):
+    """
+    Quote a (possibly schema-qualified) identifier for use in generated SQL.
+    """
+    return '.'.join('"%s"' % part.replace('"', '""') for part in name.split('.'))
+
+
+def _copy_value(value):
+    """
+    Render a value in the text format read by COPY FROM STDIN. Dicts and
+    lists are written as JSON, for json and jsonb columns.
+    """
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif isinstance(value, str):
+        pass
+    elif isinstance(value, float):
+        # str() rounds floats to 12 significant digits in Python 2.
+        value = repr(value)
+    elif isinstance(value, (int, long, Decimal, UUID)):
+        value = str(value)
+    elif isinstance(value, (datetime, date, dt_time)):
+        value = value.isoformat()
+    elif isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    elif isinstance(value, Json):
+        value = value.dumps(value.adapted)
+    elif isinstance(value, (bytearray, buffer, memoryview)):
+        value = '\\x' + binascii.hexlify(value)
+    else:
+        raise TypeError('Cannot COPY a value of type %s' % type(value).__name__)
+    for char, escaped in _COPY_ESCAPES:
+        value = value.replace(char, escaped)
+    return value
+
+
+def _freeze(params):
+    """
+    Turn query parameters into something hashable, for use in a cache key.
+    """
+    if isinstance(params, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in params.items()))
+    if isinstance(params, (list, tuple)):
+        return tuple(_freeze(v) for v in params)
+    return params
+
+
+class BulkInsertResult(object):
+    """
+    Summary of a DatabasePool.bulk_insert call.
+    """
+    def __init__(self, rows, seconds):
+        self.rows = rows
+        self.seconds = seconds
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else float(self.rows)
+
+    def __repr__(self):
+        return "<%s: %d rows in %.2fs (%.0f rows/s)>" % (
+            self.__class__.__name__, self.rows, self.seconds, self.rows_per_second)
+
 
 class EnvironmentVariableNotFoundException(Exception):
     pass
 
 
+class PoolTimeoutError(RuntimeError):
+    """
+    Raised when no connection became available within the checkout timeout.
+    """
+    pass
+
+
 class PoolManager:
     """
     Provides convenience methods around creating DatabasePool objects, and
@@ -21,6 +155,29 @@ class PoolManager:
     """
     _connections = {}
 
+    @classmethod
+    def before_fork(cls):
+        """
+        Close all pools before forking worker processes, so that no connection
+        is shared between processes. Pools reopen lazily on first use.
+        """
+        for database_pool in cls._connections.values():
+            database_pool.close()
+
+    @classmethod
+    def after_fork(cls, warm_up=False):
+        """
+        Adopt the pools created before a fork in the current process, and
+        optionally open their connections right away.
+        """
+        pid = os.getpid()
+        cls._connections = dict(((pid, key), database_pool)
+                                for (_, key), database_pool in cls._connections.items())
+        if warm_up:
+            for database_pool in cls._connections.values():
+                if isinstance(database_pool, DatabasePool):
+                    database_pool.warm_up()
+
     @staticmethod
     def get_url_from_environment(name=None):
         """
@@ -37,12 +194,30 @@ class PoolManager:
         raise EnvironmentVariableNotFoundException(
             "The envrionment variables %s were not found." % ' or '.join(attempts))
 
+    @staticmethod
+    def get_replica_urls_from_environment(env):
+        """
+        Return the comma separated replica URLs that go with the database URL
+        in env, following our convention of NAME_REPLICA_URLS alongside
+        NAME_DATABASE_URL.
+
+        """
+        if env.endswith('DATABASE_URL'):
+            env = env[:-len('DATABASE_URL')]
+        else:
+            env += '_'
+        urls = os.environ.get('%sREPLICA_URLS' % env, '')
+        return tuple(url.strip() for url in urls.split(',') if url.strip())
+
     @classmethod
     def from_name(cls, name, **kwargs):
         """
         Return a pool instance by name (following our convention of NAME_DATABASE_URL)
         first checking to see if it's already been created and returning that instance.
 
+        If NAME_REPLICA_URLS is also set, read-only cursors are routed to those
+        replicas.
+
         See the DatabasePool class below for more information on the additional
         arguments that can be passed to this method.
 
@@ -55,35 +230,376 @@ class PoolManager:
         # Set the name for the DatabasePool to the environment variable
         kwargs['name'] = env
 
+        if 'replica_urls' not in kwargs:
+            replica_urls = cls.get_replica_urls_from_environment(env)
+            if replica_urls:
+                kwargs['replica_urls'] = replica_urls
+
         return cls.from_url(url, **kwargs)
 
     @classmethod
-    def from_url(cls, url, **kwargs):
+    def from_url(cls, url, pool_class=None, **kwargs):
         """
         Return a pool instance by Database URL.
 
+        pool_class defaults to DatabasePool; pass AsyncDatabasePool for a pool
+        of asynchronous connections.
+
         See the DatabasePool class below for more information on the additional
         arguments that can be passed to this method.
 
         """
+        pool_class = pool_class or DatabasePool
         kwargs['connection_url'] = url
 
         # If cached=False is provided, return a fresh instance.
         if not kwargs.get('cached', True):
-            return DatabasePool(**kwargs)
+            return pool_class(**kwargs)
 
-        # Generate a hashing key based on the keyword arguments.
-        cache_key = hash(frozenset(kwargs.items()))
+        # Generate a hashing key based on the pool class and keyword arguments,
+        # keeping pools separate between processes.
+        cache_key = (os.getpid(), hash((pool_class, frozenset(kwargs.items()))))
 
         if cache_key in cls._connections:
             return cls._connections.get(cache_key)
 
-        new_conn = DatabasePool(**kwargs)
+        new_conn = pool_class(**kwargs)
         cls._connections[cache_key] = new_conn
         return new_conn
 
 
-class DatabasePool:
+class LivenessPolicy(object):
+    """
+    Decides how much work goes into making sure a pooled connection is still
+    usable before it is handed out.
+
+    - idle_threshold is the number of seconds a connection may sit idle before
+      it is verified with a round trip to the server
+    - max_lifetime is the number of seconds after which a connection is closed
+      and replaced, None to keep connections forever
+    - local_check enables a cheap check of the connection status and socket
+      for connections that have not been idle long enough to need a round trip
+    - reap_interval is how often, in seconds, idle connections past their
+      max_lifetime are replaced in the background
+
+    """
+    def __init__(self, idle_threshold=30, max_lifetime=3600, local_check=True, reap_interval=60):
+        self.idle_threshold = idle_threshold
+        self.max_lifetime = max_lifetime
+        self.local_check = local_check
+        self.reap_interval = reap_interval
+
+    def is_expired(self, info, now):
+        return self.max_lifetime is not None and now - info.created_at >= self.max_lifetime
+
+    def check(self, con, info, now=None):
+        """
+        Return True if the connection may be handed out, False if it should be
+        discarded. Errors raised by the connection while checking propagate.
+        """
+        now = now or time.time()
+        if con.closed or self.is_expired(info, now):
+            return False
+
+        if now - info.last_used < self.idle_threshold:
+            if not self.local_check:
+                return True
+            if con.status != psycopg2.extensions.STATUS_READY:
+                return False
+            # The server sends nothing to an idle connection unprompted, except
+            # on error or when closing it (or for LISTEN notifications), so an
+            # unreadable socket means the connection is still open. Otherwise
+            # fall through to a round trip, which raises if it is gone. poll,
+            # unlike select, takes descriptors past FD_SETSIZE.
+            poller = select.poll()
+            poller.register(con.fileno(), select.POLLIN | select.POLLPRI)
+            if not poller.poll(0):
+                return True
+
+        cur = con.cursor()
+        cur.execute("SELECT 42;")
+        cur.close()
+        info.last_verified = now
+        return True
+
+
+class ConnectionInfo(object):
+    """
+    Bookkeeping for a single pooled connection: when it was opened, last used
+    and last verified, the statements prepared on it (an LRU of query text to
+    statement name) and those still to deallocate. A reconnect gets a fresh
+    ConnectionInfo, so prepared statements never outlive the session they were
+    prepared in.
+    """
+    __slots__ = ('created_at', 'last_used', 'last_verified', 'prepared', 'stale')
+
+    def __init__(self, now):
+        self.created_at = now
+        self.last_used = now
+        self.last_verified = now
+        self.prepared = OrderedDict()
+        self.stale = []
+
+
+class _Statement(object):
+    """
+    A query rewritten from psycopg2 placeholders to PREPARE's $n parameters,
+    along with how many times it has been run through the pool and whether it
+    can be prepared at all.
+    """
+    __slots__ = ('text', 'keys', 'args', 'count', 'hot', 'preparable')
+
+    def __init__(self, sql, hot=False):
+        keys = []
+
+        def number(match):
+            if match.group(0) == '%%':
+                return '%'
+            key = match.group(1)
+            if key is None:
+                keys.append(None)
+                return '$%d' % len(keys)
+            if key not in keys:
+                keys.append(key)
+            return '$%d' % (keys.index(key) + 1)
+
+        self.text = _PLACEHOLDER.sub(number, sql)
+        self.keys = keys
+        self.args = '(%s)' % ', '.join(['%s'] * len(keys)) if keys else ''
+        self.count = 0
+        self.hot = hot
+        self.preparable = _PREPARABLE.match(sql) is not None and ';' not in sql.strip().rstrip(';')
+
+    def values(self, params):
+        if not self.keys:
+            return None
+        if isinstance(params, dict):
+            return [params[key] for key in self.keys]
+        return list(params)
+
+    def accepts(self, params):
+        """
+        Whether params can be sent as EXECUTE arguments. Tuples are expanded
+        by psycopg2 into lists of values (as in IN %s), which a single $n
+        parameter can't stand for.
+        """
+        if params is None:
+            return True
+        values = params.values() if isinstance(params, dict) else params
+        return not any(isinstance(value, tuple) for value in values)
+
+
+class _ConnectionPool(pool.ThreadedConnectionPool):
+    """
+    ThreadedConnectionPool that tracks a ConnectionInfo for every connection it
+    opens and can replace idle connections that have grown too old.
+
+    When every connection is in use, getconn() queues the caller rather than
+    raising, and connections are handed out to waiters first come first served.
+    """
+    def __init__(self, *args, **kwargs):
+        self._info = {}
+        self._waiters = deque()
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_histogram = [0] * (len(CHECKOUT_WAIT_BUCKETS_MS) + 1)
+        pool.ThreadedConnectionPool.__init__(self, *args, **kwargs)
+
+    def _available(self):
+        # Must be called with the lock held.
+        return len(self._used) < self.maxconn
+
+    def getconn(self, key=None, timeout=None):
+        """
+        Get a connection, waiting up to timeout seconds (forever if None) for
+        one to be returned if the pool is exhausted.
+        """
+        start = time.time()
+        self._lock.acquire()
+        try:
+            if self._waiters or not self._available():
+                self._wait_turn(start, timeout)
+            con = self._getconn(key)
+            self.checkouts += 1
+            self._record_wait((time.time() - start) * 1000)
+            return con
+        finally:
+            self._lock.release()
+
+    def _wait_turn(self, start, timeout):
+        # Must be called with the lock held; returns with it held.
+        waiter = threading.Condition(self._lock)
+        self._waiters.append(waiter)
+        self.waits += 1
+        try:
+            while self._waiters[0] is not waiter or not self._available():
+                remaining = None
+                if timeout is not None:
+                    remaining = start + timeout - time.time()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeoutError('Timed out after %ss waiting for a connection' % timeout)
+                waiter.wait(remaining)
+        finally:
+            self._waiters.remove(waiter)
+            self._notify()
+
+    def outstanding(self):
+        """
+        Number of connections checked out or waited for.
+        """
+        return len(self._used) + len(self._waiters)
+
+    def _notify(self):
+        # Must be called with the lock held.
+        if self._waiters and self._available():
+            self._waiters[0].notify()
+
+    def _record_wait(self, wait_ms):
+        for i, bound in enumerate(CHECKOUT_WAIT_BUCKETS_MS):
+            if wait_ms <= bound:
+                break
+        else:
+            i = len(CHECKOUT_WAIT_BUCKETS_MS)
+        self.wait_histogram[i] += 1
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return {
+                'in_use': len(self._used),
+                'idle': len(self._pool),
+                'waiting': len(self._waiters),
+                'max': self.maxconn,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'wait_ms_histogram': OrderedDict(zip(_CHECKOUT_WAIT_LABELS, self.wait_histogram)),
+            }
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def unopened_stats(maxconn):
+        """stats() of a pool that hasn't been opened."""
+        return {
+            'in_use': 0,
+            'idle': 0,
+            'waiting': 0,
+            'max': maxconn,
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'wait_ms_histogram': OrderedDict((label, 0) for label in _CHECKOUT_WAIT_LABELS),
+        }
+
+    def _open(self):
+        con = psycopg2.connect(*self._args, **self._kwargs)
+        self._info[id(con)] = ConnectionInfo(time.time())
+        return con
+
+    def _connect(self, key=None):
+        con = self._open()
+        if key is not None:
+            self._used[key] = con
+            self._rused[id(con)] = key
+        else:
+            self._pool.append(con)
+        return con
+
+    def _putconn(self, conn, key=None, close=False):
+        pool.ThreadedConnectionPool._putconn(self, conn, key, close)
+        if conn.closed:
+            self._info.pop(id(conn), None)
+        self._notify()
+
+    def info(self, con):
+        return self._info[id(con)]
+
+    def replace_expired(self, policy):
+        """
+        Close idle connections that the policy considers expired and open
+        replacements for them, so checkouts don't pay for the reconnect.
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            if self.closed:
+                return
+            expired = [con for con in self._pool if policy.is_expired(self._info[id(con)], now)]
+            for con in expired:
+                self._pool.remove(con)
+                self._info.pop(id(con), None)
+        finally:
+            self._lock.release()
+
+        for con in expired:
+            try:
+                con.close()
+            except psycopg2.Error:
+                pass
+
+        for _ in expired:
+            try:
+                con = self._open()
+            except psycopg2.Error as e:
+                logging.warning('Could not replace expired connection: %s', e)
+                return
+            self._lock.acquire()
+            try:
+                if self.closed or len(self._pool) >= self.minconn:
+                    con.close()
+                    self._info.pop(id(con), None)
+                else:
+                    self._pool.append(con)
+            finally:
+                self._lock.release()
+
+
+class _Periodic(threading.Thread):
+    """
+    Daemon thread that calls func every interval seconds until stopped.
+    All such threads are stopped at exit, before module teardown.
+    """
+    _running = weakref.WeakSet()
+
+    def __init__(self, name, interval, func):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self._interval = interval
+        self._func = func
+        self._stopped = threading.Event()
+        self._running.add(self)
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self._func()
+            except Exception as e:
+                logging.warning('Error in %s: %s', self.name, e)
+
+    def stop(self):
+        self._stopped.set()
+
+    @classmethod
+    def stop_all(cls, timeout=1):
+        threads = list(cls._running)
+        for thread in threads:
+            thread.stop()
+        for thread in threads:
+            if thread.is_alive():
+                thread.join(timeout)
+
+
+atexit.register(_Periodic.stop_all)
+
+# Connection pools inherited from a parent process, kept alive so that they are
+# never closed from the child.
+_inherited_pools = []
+
+
+class DatabasePool(object):
     """
     Creates and manages a pool of connections to a database.
 
@@ -94,38 +610,305 @@ class DatabasePool:
     - mincount is the minimum number of connections to keep open
     - maxcount is the maximum number of connections to have open
     - cursor_factory defines the factory used for inflating database rows
+    - liveness is the LivenessPolicy used to verify connections on checkout
+    - query_cache is the LRUCache backing query(..., cache_ttl=...)
+    - prepare_threshold is the number of times a query must be run through
+      query() before it is prepared on each connection, None (the default) to
+      only prepare statements marked with mark_hot()
+    - max_prepared is the number of prepared statements kept per connection
+    - checkout_timeout is the number of seconds to wait for a connection when
+      all maxcount are in use before raising PoolTimeoutError, None to wait
+      forever
+    - report_metrics forwards checkout wait times, timeouts and usage to
+      statsd through flutil.metrics
+    - metrics_interval is how often, in seconds, usage gauges and checkout
+      counts are sent when report_metrics is set
+    - replica_urls are DSNs of read replicas that read-only cursors are
+      routed to, each with its own pool built with the same options
+    - max_replica_lag is the replication lag, in seconds, beyond which a
+      replica stops receiving reads
+    - lag_probe_interval is how often, in seconds, replica lag is measured
 
     """
-    def __init__(self, connection_url, name=None, mincount=2, maxcount=40, cursor_factory=RealDictCursor, **kwargs):
+    def __init__(self, connection_url, name=None, mincount=2, maxcount=40, cursor_factory=RealDictCursor,
+                 liveness=None, query_cache=None, prepare_threshold=None, max_prepared=100, checkout_timeout=30,
+                 report_metrics=False, metrics_interval=10, replica_urls=(), max_replica_lag=10, lag_probe_interval=5,
+                 **kwargs):
         self.connection_url = connection_url
         self.name = name or connection_url
-        self._pool = pool.ThreadedConnectionPool(mincount, maxcount, connection_url, cursor_factory=cursor_factory)
+        self.checkout_timeout = checkout_timeout
+        self._metrics = None
+        if report_metrics:
+            from flutil import metrics
+            self._metrics = metrics
+            # Don't leak credentials from the connection URL into metric names.
+            self._metrics_prefix = 'db.%s' % re.sub(r'\W+', '_', (name or 'pool').lower())
+        self.liveness = liveness or LivenessPolicy()
+        self.query_cache = query_cache or LRUCache()
+        self.prepare_threshold = prepare_threshold
+        self.max_prepared = max_prepared
+        self._statements = {}
+        self._statements_lock = threading.Lock()
+        self._pool_args = (mincount, maxcount, connection_url)
+        self._pool_kwargs = {'cursor_factory': cursor_factory}
+        self._connection_pool = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._reaper = None
+        self.metrics_interval = metrics_interval
+        self._reporter = None
+        self._reported = {}
+
+        self.max_replica_lag = max_replica_lag
+        self.lag_probe_interval = lag_probe_interval
+        # Replicas receive reads once a probe has found them close enough.
+        self.replication_lag = float('inf')
+        self._pinned = threading.local()
+        self._replicas = [
+            DatabasePool(url, name='%s_replica_%d' % (name or 'pool', i), mincount=mincount, maxcount=maxcount,
+                         cursor_factory=cursor_factory, liveness=liveness, prepare_threshold=prepare_threshold,
+                         max_prepared=max_prepared, checkout_timeout=checkout_timeout, report_metrics=report_metrics,
+                         metrics_interval=metrics_interval)
+            for i, url in enumerate(replica_urls)
+        ]
+        self._lag_probe = None
 
     def __repr__(self):
         return "<%s: %s>" % (self.__class__.__name__, self.name)
 
     def __del__(self):
-        self._pool.closeall()
+        # A pool inherited across a fork belongs to the parent; leave it be.
+        if self._pid == os.getpid():
+            self.close()
+
+    @property
+    def _pool(self):
+        """
+        The underlying connection pool, opened on first use in each process.
+        """
+        connection_pool = self._connection_pool
+        if connection_pool is None or self._pid != os.getpid():
+            connection_pool = self._start()
+        return connection_pool
+
+    def _start(self):
+        with self._start_lock:
+            pid = os.getpid()
+            if self._connection_pool is not None:
+                if self._pid == pid:
+                    return self._connection_pool
+                # Inherited across a fork: its sockets are shared with the parent,
+                # so closing (or garbage collecting) it here would break the
+                # parent's sessions. Keep it referenced and start afresh.
+                _inherited_pools.append(self._connection_pool)
+
+            self._connection_pool = _ConnectionPool(*self._pool_args, **self._pool_kwargs)
+            self._pid = pid
+            if self.liveness.max_lifetime is not None and self.liveness.reap_interval:
+                self._reaper = _Periodic('flutil-db-reaper', self.liveness.reap_interval, self._reap)
+                self._reaper.start()
+            if self._metrics is not None and self.metrics_interval:
+                self._reported = {}
+                self._reporter = _Periodic('flutil-db-metrics', self.metrics_interval, self._report_metrics)
+                self._reporter.start()
+            if self._replicas:
+                self._lag_probe = _Periodic('flutil-db-lag-probe', self.lag_probe_interval, self._probe_replicas)
+                self._lag_probe.start()
+            return self._connection_pool
+
+    def warm_up(self):
+        """
+        Open the pool (and those of any replicas) now, rather than on the first
+        checkout, so that mincount connections are ready to use.
+        """
+        self._pool
+        for replica in self._replicas:
+            replica.warm_up()
+
+    def close(self):
+        """
+        Close every connection in this process. The pool is reopened on next use.
+        """
+        with self._start_lock:
+            if self._reaper:
+                self._reaper.stop()
+                self._reaper = None
+            if self._reporter:
+                self._reporter.stop()
+                self._reporter = None
+            if self._lag_probe:
+                self._lag_probe.stop()
+                self._lag_probe = None
+            if self._connection_pool is not None and self._pid == os.getpid():
+                self._connection_pool.closeall()
+                self._connection_pool = None
+        for replica in self._replicas:
+            replica.close()
+
+    def _reap(self):
+        self._pool.replace_expired(self.liveness)
+
+    def _report_metrics(self):
+        """
+        Send gauges of the connections in use, idle and waited for, and counts
+        of the checkouts, waits and timeouts since the last report. Checkout
+        wait times are sent as timers on every checkout.
+        """
+        stats = self._pool.stats()
+        for key in ('in_use', 'idle', 'waiting'):
+            self._metrics.gauge('%s.%s' % (self._metrics_prefix, key), stats[key])
+        for key, metric in (('checkouts', 'checkouts'), ('waits', 'checkout_waits'),
+                            ('timeouts', 'checkout_timeout')):
+            count = stats[key] - self._reported.get(key, 0)
+            self._reported[key] = stats[key]
+            if count:
+                self._metrics.incr('%s.%s' % (self._metrics_prefix, metric), count)
+
+    def _probe_replicas(self):
+        """
+        Measure the replication lag of every replica. Replicas that can't be
+        reached are treated as infinitely far behind until the next probe.
+        """
+        for replica in self._replicas:
+            try:
+                with replica.cursor() as cur:
+                    if cur.connection.server_version >= 100000:
+                        cur.execute(REPLICATION_LAG_QUERY)
+                    else:
+                        cur.execute(REPLICATION_LAG_QUERY_9)
+                    row = cur.fetchone()
+                lag = row['lag'] if isinstance(row, dict) else row[0]
+                replica.replication_lag = float(lag or 0)
+            except Exception as e:
+                logging.warning('Could not measure replication lag of %s: %s', replica.name, e)
+                replica.replication_lag = float('inf')
+
+    def _route(self, readonly):
+        """
+        Pick the pool to serve a checkout: the replica within max_replica_lag
+        with the fewest outstanding checkouts for reads, otherwise the primary.
+        """
+        if not readonly or not self._replicas or getattr(self._pinned, 'depth', 0):
+            return self
+        # Opening the primary's pool also starts the lag probe in this process.
+        self._pool
+        replicas = [r for r in self._replicas if r.replication_lag <= self.max_replica_lag]
+        if not replicas:
+            return self
+        return min(replicas, key=lambda r: r._pool.outstanding())
 
     @contextmanager
-    def cursor(self, commit_on_close=False):
+    def pin_to_primary(self):
         """
-        Fetches a cursor from the database connection pool.
-        We run a dummy query because we have experienced stale connections that fail
-        to correctly report that their connection has closed, and cause OperationalErrors.
+        Route read-only cursors opened by this thread within the block to the
+        primary, so they see writes made earlier in the block.
+        """
+        self._pinned.depth = getattr(self._pinned, 'depth', 0) + 1
+        try:
+            yield self
+        finally:
+            self._pinned.depth -= 1
+
+    def _checkout(self):
+        """
+        Get a verified connection from the pool, discarding any connections
+        that fail the liveness check along the way.
         """
         for _ in range(MAX_CONNECTION_ATTEMPTS):
+            con = None
             try:
-                con = self._pool.getconn()
-                test_cur = con.cursor()
-                test_cur.execute("SELECT 42;")
-                test_cur.close()
-                break
-            except psycopg2.DatabaseError, psycopg2.OperationalError:
+                con = self._getconn()
+                if self.liveness.check(con, self._pool.info(con)):
+                    return con
+            except (psycopg2.DatabaseError, psycopg2.OperationalError):
                 pass
+            except:
+                # Anything else is not the connection's fault, but don't let it keep a slot.
+                if con is not None:
+                    self._discard(con)
+                raise
+            if con is not None:
+                self._discard(con)
+        raise RuntimeError('Could not get a connection to: {}'.format(self.name))
+
+    def _getconn(self):
+        if self._metrics is None:
+            return self._pool.getconn(timeout=self.checkout_timeout)
+
+        start = time.time()
+        con = self._pool.getconn(timeout=self.checkout_timeout)
+        self._metrics.timing('%s.checkout_wait_ms' % self._metrics_prefix, (time.time() - start) * 1000)
+        return con
+
+    def stats(self):
+        """
+        Return a snapshot of the pool: connections in use, idle and waited for,
+        checkout counts, timeouts and a histogram of checkout wait times, along
+        with the same for each replica and its replication lag. A pool that
+        hasn't been opened in this process reports zeros, rather than opening.
+        """
+        connection_pool = self._connection_pool
+        if connection_pool is None or self._pid != os.getpid():
+            stats = _ConnectionPool.unopened_stats(self._pool_args[1])
         else:
-            raise RuntimeError('Could not get a connection to: {}'.format(self.name))
+            stats = connection_pool.stats()
+        if self._replicas:
+            stats['replicas'] = {}
+            for replica in self._replicas:
+                replica_stats = replica.stats()
+                replica_stats['replication_lag'] = replica.replication_lag
+                stats['replicas'][replica.name] = replica_stats
+        return stats
+
+    def _info(self, con):
+        """
+        ConnectionInfo of a connection checked out of this pool or, for
+        read-only cursors, of one of its replicas.
+        """
+        for database_pool in [self] + self._replicas:
+            connection_pool = database_pool._connection_pool
+            if connection_pool is not None and database_pool._pid == os.getpid():
+                try:
+                    return connection_pool.info(con)
+                except KeyError:
+                    pass
+        raise KeyError('Connection does not belong to %s' % self.name)
 
+    def _checkin(self, con):
+        """
+        Return a connection to the pool, stamping when it was last used.
+        """
+        try:
+            self._pool.info(con).last_used = time.time()
+            self._pool.putconn(con)
+        except:
+            pass
+
+    def _discard(self, con):
+        try:
+            self._pool.putconn(con, close=True)
+        except:
+            pass
+
+    @contextmanager
+    def cursor(self, commit_on_close=False, readonly=False):
+        """
+        Fetches a cursor from the database connection pool, or from a replica's
+        pool if readonly is set and a replica is available.
+
+        We have experienced stale connections that fail to correctly report that
+        their connection has closed, and cause OperationalErrors. Rather than
+        running a dummy query on every checkout, connections are verified
+        according to the pool's LivenessPolicy: only those idle past its
+        threshold pay for a round trip, and broken ones are discarded.
+        """
+        target = self._route(readonly)
+        if target is not self:
+            with target.cursor(commit_on_close) as cur:
+                yield cur
+            return
+
+        con = self._checkout()
         try:
             yield con.cursor()
             if commit_on_close:
@@ -133,7 +916,641 @@ class DatabasePool:
         except pool.PoolError as e:
             logging.log(logging.ERROR, e.message)
         finally:
+            self._checkin(con)
+
+    def query(self, sql, params=None, cache_ttl=None, tags=(), readonly=False):
+        """
+        Run a query and return all of its rows, on a replica if readonly is set
+        and one is available.
+
+        If cache_ttl is given the rows are cached in query_cache for that many
+        seconds, keyed by sql and params, and concurrent misses share a single
+        round trip. Tag entries with the tables they read so writers can drop
+        them with invalidate():
+
+            fields = pool.query('SELECT * FROM fields', cache_ttl=300, tags=['fields'])
+            ...
+            pool.invalidate('fields')
+
+        Cached rows are shared between callers and must not be modified.
+        """
+        def run():
+            target = self._route(readonly)
+            with target.cursor() as cur:
+                target.execute(cur, sql, params)
+                return cur.fetchall()
+
+        if cache_ttl is None:
+            return run()
+
+        try:
+            key = (sql, _freeze(params))
+            hash(key)
+        except TypeError:
+            return run()
+        return self.query_cache.get_or_load(key, run, ttl=cache_ttl, tags=tags)
+
+    def invalidate(self, *tags):
+        """
+        Drop cached query results carrying any of the given tags.
+        """
+        self.query_cache.invalidate(*tags)
+
+    def mark_hot(self, *queries):
+        """
+        Prepare the given queries on every connection the first time they are
+        run through query() or execute(), without waiting for prepare_threshold.
+        """
+        with self._statements_lock:
+            for sql in queries:
+                statement = self._statements.get(sql)
+                if statement is None:
+                    self._statements[sql] = _Statement(sql, hot=True)
+                else:
+                    statement.hot = True
+
+    def execute(self, cur, sql, params=None):
+        """
+        Execute a query on a cursor from this pool, using a statement prepared
+        on the cursor's connection once the query is hot: either marked with
+        mark_hot() or run prepare_threshold times. Prepared statements are kept
+        in a per-connection LRU of max_prepared entries.
+
+        Only single SELECT, INSERT, UPDATE, DELETE, VALUES and WITH statements
+        are prepared, and only when no parameter is a tuple. If PREPARE still
+        fails, for instance because a parameter is spliced into the query as
+        SQL, the query is executed as is from then on. The failed PREPARE is
+        rolled back to a savepoint, leaving the caller's transaction intact.
+        """
+        with self._statements_lock:
+            statement = self._statements.get(sql)
+            if statement is None and self.prepare_threshold is not None:
+                if len(self._statements) >= MAX_TRACKED_STATEMENTS:
+                    self._evict_statements()
+                if len(self._statements) < MAX_TRACKED_STATEMENTS:
+                    statement = self._statements[sql] = _Statement(sql)
+            if statement is not None:
+                statement.count += 1
+        if statement is None:
+            return cur.execute(sql, params)
+
+        if not statement.preparable or not statement.accepts(params) or (
+                not statement.hot and (self.prepare_threshold is None or statement.count < self.prepare_threshold)):
+            return cur.execute(sql, params)
+
+        info = self._info(cur.connection)
+        prepared = info.prepared
+        name = prepared.pop(sql, None)
+        if name is None:
+            while info.stale:
+                cur.execute('DEALLOCATE %s' % info.stale.pop())
+            name = 'flutil_stmt_%d' % next(_statement_ids)
+            if not self._prepare(cur, name, statement):
+                return cur.execute(sql, params)
+            while len(prepared) >= self.max_prepared:
+                _, evicted = prepared.popitem(last=False)
+                cur.execute('DEALLOCATE %s' % evicted)
+        # If EXECUTE fails the statement may have been invalidated (e.g. by a
+        # schema change), so it is only put back in the LRU once it succeeds.
+        try:
+            cur.execute('EXECUTE %s%s' % (name, statement.args), statement.values(params))
+        except psycopg2.Error:
+            exc_info = sys.exc_info()
+            self._deallocate(cur, name, info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        prepared[sql] = name
+
+    def _prepare(self, cur, name, statement):
+        """
+        Prepare a statement on the cursor's connection, returning False and
+        marking it as not preparable if the server rejects it.
+        """
+        in_transaction = not cur.connection.autocommit
+        try:
+            if in_transaction:
+                cur.execute('SAVEPOINT flutil_prepare')
+            cur.execute('PREPARE %s AS %s' % (name, statement.text))
+        except psycopg2.Error as e:
+            if in_transaction:
+                cur.execute('ROLLBACK TO SAVEPOINT flutil_prepare')
+            logging.info('Not preparing query on %s: %s', self.name, e)
+            statement.preparable = False
+            return False
+        if in_transaction:
+            cur.execute('RELEASE SAVEPOINT flutil_prepare')
+        return True
+
+    def _deallocate(self, cur, name, info):
+        """
+        Deallocate a statement whose EXECUTE failed. If the failure aborted the
+        transaction, it is deallocated before the next PREPARE on the
+        connection instead.
+        """
+        if cur.connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            info.stale.append(name)
+            return
+        try:
+            cur.execute('DEALLOCATE %s' % name)
+        except psycopg2.Error:
+            # Already gone, along with the session if the connection broke.
+            pass
+
+    def _evict_statements(self):
+        """
+        Stop tracking queries that are neither hot nor prepared yet, to make
+        room for new ones. Called with _statements_lock held.
+        """
+        for sql, statement in self._statements.items():
+            if not statement.hot and (not statement.preparable or self.prepare_threshold is None
+                                      or statement.count < self.prepare_threshold):
+                self._statements.pop(sql, None)
+
+    def stream(self, query, params=None, batch_size=2000, row_format='tuple', readonly=False):
+        """
+        Run a query on a named server-side cursor and yield its rows, fetching
+        batch_size rows at a time as the consumer pulls them, so memory use
+        stays flat regardless of the size of the result.
+
+        row_format is one of 'tuple', 'dict' or 'namedtuple'. The connection is
+        returned to the pool when the generator is exhausted or closed. If
+        readonly is set the query runs on a replica when one is available.
+
+            for row in pool.stream('SELECT * FROM foo', batch_size=5000):
+                ...
+        """
+        try:
+            cursor_factory = ROW_FORMATS[row_format]
+        except KeyError:
+            raise ValueError('row_format must be one of: %s' % ', '.join(sorted(ROW_FORMATS)))
+
+        target = self._route(readonly)
+        con = target._checkout()
+        try:
+            cur = con.cursor('flutil_stream_%d' % next(_stream_ids), cursor_factory=cursor_factory)
+            cur.itersize = batch_size
             try:
-                self._pool.putconn(con)
+                cur.execute(query, params)
+                while True:
+                    rows = cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+            finally:
+                cur.close()
+        finally:
+            # Named cursors live inside a transaction; putconn rolls it back.
+            target._checkin(con)
+
+    def bulk_insert(self, table, columns, rows, on_conflict=None, chunk_size=10000, page_size=1000):
+        """
+        Insert rows (any iterable of sequences matching columns) into table,
+        committing every chunk_size rows. Rows are consumed lazily, so at most
+        one chunk is buffered in memory at a time.
+
+        Without on_conflict rows are loaded with COPY FROM STDIN. With it, rows
+        are sent as multi-row INSERT ... VALUES statements of page_size rows
+        with on_conflict appended after ON CONFLICT, e.g.:
+
+            pool.bulk_insert('foo', ['id', 'bar'], rows,
+                             on_conflict='(id) DO UPDATE SET bar = EXCLUDED.bar')
+
+        If a chunk fails it is rolled back; earlier chunks stay committed.
+        Returns a BulkInsertResult.
+        """
+        target = '%s (%s)' % (_quote_ident(table), ', '.join(_quote_ident(c) for c in columns))
+        rows = iter(rows)
+        total = 0
+        start = time.time()
+
+        con = self._checkout()
+        try:
+            cur = con.cursor()
+            try:
+                while True:
+                    if on_conflict is None:
+                        count = self._copy_chunk(cur, target, rows, chunk_size)
+                    else:
+                        count = self._insert_chunk(cur, target, rows, chunk_size, page_size, on_conflict)
+                    if not count:
+                        break
+                    con.commit()
+                    total += count
             except:
+                con.rollback()
+                raise
+            finally:
+                cur.close()
+        finally:
+            self._checkin(con)
+
+        result = BulkInsertResult(total, time.time() - start)
+        logging.info('Bulk inserted into %s on %s: %r', table, self.name, result)
+        return result
+
+    @staticmethod
+    def _copy_chunk(cur, target, rows, chunk_size):
+        buf = io.BytesIO()
+        count = 0
+        for row in itertools.islice(rows, chunk_size):
+            buf.write('\t'.join(_copy_value(v) for v in row))
+            buf.write('\n')
+            count += 1
+        if count:
+            buf.seek(0)
+            cur.copy_expert('COPY %s FROM STDIN' % target, buf)
+        return count
+
+    @staticmethod
+    def _insert_chunk(cur, target, rows, chunk_size, page_size, on_conflict):
+        count = 0
+        while count < chunk_size:
+            page = list(itertools.islice(rows, min(page_size, chunk_size - count)))
+            if not page:
+                break
+            placeholders = '(%s)' % ', '.join(['%s'] * len(page[0]))
+            values = ', '.join(cur.mogrify(placeholders, row) for row in page)
+            cur.execute('INSERT INTO %s VALUES %s ON CONFLICT %s' % (target, values, on_conflict))
+            count += len(page)
+        return count
+
+
+class _AsyncCursor(object):
+    """
+    Cursor on a connection checked out of an AsyncDatabasePool. execute() and
+    callproc() return Futures; everything else is proxied to the psycopg2
+    cursor. Leaving the with block returns the connection to the pool.
+    """
+    def __init__(self, pool, con, cursor):
+        self._pool = pool
+        self._con = con
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def execute(self, sql, params=None):
+        self._cursor.execute(sql, params)
+        return self._pool._wait(self._con)
+
+    def callproc(self, procname, params=None):
+        self._cursor.callproc(procname, params)
+        return self._pool._wait(self._con)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._pool._release(self._con)
+
+
+class AsyncDatabasePool(object):
+    """
+    Creates and manages a pool of asynchronous connections to a database,
+    driven by the Tornado IOLoop, so many queries can be in flight at once
+    without a thread each.
+
+    See http://initd.org/psycopg/docs/advanced.html#async-support
+
+    - connection_url is a postgresql://user@host/database style DSN
+    - name is an optional nickname for the database connection
+    - mincount is the number of connections opened by warm_up()
+    - maxcount is the maximum number of connections to have open
+    - cursor_factory defines the factory used for inflating database rows
+    - checkout_timeout is the number of seconds to wait for a free connection
+      before raising PoolTimeoutError, None to wait forever
+    - ioloop is the IOLoop to run on, defaulting to IOLoop.current()
+
+    Asynchronous connections are always in autocommit mode. Checkouts beyond
+    maxcount wait for a connection to be released, first come first served:
+
+        with (yield pool.cursor()) as cur:
+            yield cur.execute('SELECT * FROM foo WHERE bar = %s', (bar,))
+            rows = cur.fetchall()
+
+        foos, bars = yield [pool.query('SELECT * FROM foo'),
+                            pool.query('SELECT * FROM bar')]
+
+    """
+    def __init__(self, connection_url, name=None, mincount=2, maxcount=10, cursor_factory=RealDictCursor,
+                 checkout_timeout=30, ioloop=None, **kwargs):
+        self.connection_url = connection_url
+        self.name = name or connection_url
+        self.mincount = mincount
+        self.maxcount = maxcount
+        self.cursor_factory = cursor_factory
+        self.checkout_timeout = checkout_timeout
+        self._explicit_ioloop = ioloop
+        self._idle = []
+        self._waiters = deque()
+        self._size = 0
+        self._pid = os.getpid()
+
+    def __repr__(self):
+        return "<%s: %s>" % (self.__class__.__name__, self.name)
+
+    @property
+    def _ioloop(self):
+        # Resolved on use: Tornado refuses to fork once an IOLoop exists.
+        return self._explicit_ioloop or IOLoop.current()
+
+    def _check_pid(self):
+        """
+        Forget connections inherited across a fork, without closing them from
+        the child.
+        """
+        pid = os.getpid()
+        if self._pid != pid:
+            _inherited_pools.append(self._idle)
+            self._idle = []
+            self._waiters = deque()
+            self._size = 0
+            self._pid = pid
+
+    def _wait(self, con):
+        """
+        Return a Future resolved once con is done with its current operation.
+        """
+        future = Future()
+        fd = con.fileno()
+        registered = []
+
+        def poll(fd=fd, events=None):
+            try:
+                state = con.poll()
+            except Exception:
+                if registered:
+                    self._ioloop.remove_handler(fd)
+                future.set_exc_info(sys.exc_info())
+                return
+
+            if state == psycopg2.extensions.POLL_OK:
+                if registered:
+                    self._ioloop.remove_handler(fd)
+                future.set_result(con)
+                return
+
+            events = IOLoop.READ if state == psycopg2.extensions.POLL_READ else IOLoop.WRITE
+            if registered:
+                self._ioloop.update_handler(fd, events)
+            else:
+                self._ioloop.add_handler(fd, poll, events)
+                registered.append(True)
+
+        poll()
+        return future
+
+    def _connect(self):
+        con = psycopg2.connect(self.connection_url, async=1)
+        return self._wait(con)
+
+    @gen.coroutine
+    def warm_up(self):
+        """
+        Open connections until mincount are idle in the pool.
+        """
+        self._check_pid()
+        while len(self._idle) < self.mincount and self._size < self.maxcount:
+            self._size += 1
+            try:
+                con = yield self._connect()
+            except Exception:
+                self._size -= 1
+                raise
+            self._release(con)
+
+    @gen.coroutine
+    def _acquire(self):
+        self._check_pid()
+        while self._idle:
+            con = self._idle.pop()
+            if not con.closed:
+                raise gen.Return(con)
+            self._size -= 1
+
+        if self._size < self.maxcount:
+            self._size += 1
+            try:
+                con = yield self._connect()
+            except Exception:
+                self._size -= 1
+                raise
+            raise gen.Return(con)
+
+        waiter = Future()
+        self._waiters.append(waiter)
+        if self.checkout_timeout is None:
+            con = yield waiter
+        else:
+            try:
+                con = yield gen.with_timeout(timedelta(seconds=self.checkout_timeout), waiter,
+                                             io_loop=self._ioloop)
+            except gen.TimeoutError:
+                if waiter.done():
+                    # Handed a connection just as the timeout fired; use it rather than lose it.
+                    con = yield waiter
+                    raise gen.Return(con)
+                error = PoolTimeoutError('Timed out waiting for a connection to: {}'.format(self.name))
+                # Resolve it, so that a connection opened for it is released instead.
+                waiter.set_exception(error)
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+                raise error
+        raise gen.Return(con)
+
+    def _next_waiter(self):
+        # Skip checkouts that have timed out.
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                return waiter
+        return None
+
+    def _release(self, con):
+        """
+        Hand a connection to the longest waiting checkout, or return it to the
+        idle list. Broken connections, and connections still running a query
+        nobody waited for, are closed, and replaced if anyone is waiting.
+        """
+        if con.closed or con.isexecuting() \
+                or con.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            self._size -= 1
+            if not con.closed:
+                con.close()
+            waiter = self._next_waiter()
+            if waiter is not None:
+                self._size += 1
+
+                def connected(future):
+                    if future.exception() is not None:
+                        self._size -= 1
+                        if not waiter.done():
+                            waiter.set_exc_info(future.exc_info())
+                    elif waiter.done():
+                        self._release(future.result())
+                    else:
+                        waiter.set_result(future.result())
+                self._connect().add_done_callback(connected)
+            return
+
+        waiter = self._next_waiter()
+        if waiter is not None:
+            waiter.set_result(con)
+        else:
+            self._idle.append(con)
+
+    @gen.coroutine
+    def cursor(self):
+        """
+        Check out a connection and resolve to a cursor on it, to be used as a
+        context manager that returns the connection to the pool on exit.
+        """
+        con = yield self._acquire()
+        try:
+            cursor = con.cursor(cursor_factory=self.cursor_factory)
+        except Exception:
+            self._release(con)
+            raise
+        raise gen.Return(_AsyncCursor(self, con, cursor))
+
+    @gen.coroutine
+    def query(self, sql, params=None):
+        """
+        Run a query and resolve to all of its rows.
+        """
+        with (yield self.cursor()) as cur:
+            yield cur.execute(sql, params)
+            raise gen.Return(cur.fetchall())
+
+    def close(self):
+        """
+        Close all idle connections. Connections that are checked out go back to
+        the pool when released.
+        """
+        self._check_pid()
+        while self._idle:
+            self._idle.pop().close()
+            self._size -= 1
+
+
+def benchmark(connection_url=None, queries=5000):
+    """
+    Compare the seconds taken to run the same query queries times as is and
+    through a prepared statement, on a single connection to connection_url
+    (DATABASE_URL by default).
+    """
+    connection_url = connection_url or os.environ['DATABASE_URL']
+    sql = ('SELECT c.relname, a.attname, t.typname FROM pg_class c '
+           'JOIN pg_namespace n ON n.oid = c.relnamespace '
+           'JOIN pg_attribute a ON a.attrelid = c.oid '
+           'JOIN pg_type t ON t.oid = a.atttypid '
+           'WHERE n.nspname = %s AND c.relname = %s AND a.attnum > 0')
+    results = {}
+    for name, prepare_threshold in (('unprepared', None), ('prepared', 1)):
+        database_pool = DatabasePool(connection_url, mincount=1, maxcount=1, prepare_threshold=prepare_threshold)
+        try:
+            with database_pool.cursor() as cur:
+                start = time.time()
+                for _ in range(queries):
+                    database_pool.execute(cur, sql, ('pg_catalog', 'pg_class'))
+                    cur.fetchall()
+                results[name] = time.time() - start
+        finally:
+            database_pool.close()
+    return results
+
+
+def benchmark_stream(connection_url=None, rows=500000, batch_size=2000):
+    """
+    Compare reading rows generated on the server through a regular dict
+    cursor's fetchall and through stream, on connection_url (DATABASE_URL by
+    default), as (rows per second, growth of peak RSS in MB). Each runs in a
+    child process of its own, so that their peaks don't mix.
+    """
+    connection_url = connection_url or os.environ['DATABASE_URL']
+    sql = 'SELECT i AS id, md5(i::text) AS name, i * 0.5 AS value FROM generate_series(1, %s) i'
+
+    def fetchall(database_pool):
+        with database_pool.cursor() as cur:
+            cur.execute(sql, (rows,))
+            for row in cur.fetchall():
+                pass
+
+    def stream(row_format):
+        def run(database_pool):
+            for row in database_pool.stream(sql, (rows,), batch_size=batch_size, row_format=row_format):
                 pass
+        return run
+
+    results = {}
+    for name, run in (('fetchall', fetchall), ('stream', stream('tuple')), ('stream_dict', stream('dict'))):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            status = 1
+            try:
+                database_pool = DatabasePool(connection_url, mincount=1, maxcount=1)
+                database_pool.warm_up()
+                baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                start = time.time()
+                run(database_pool)
+                seconds = time.time() - start
+                peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                database_pool.close()
+                os.write(write_fd, json.dumps([rows / seconds, (peak - baseline) / 1024.0]))
+                status = 0
+            except Exception:
+                logging.exception('Stream benchmark %s failed', name)
+            finally:
+                os._exit(status)
+        os.close(write_fd)
+        with os.fdopen(read_fd) as output:
+            result = output.read()
+        _, status = os.waitpid(pid, 0)
+        if status:
+            raise RuntimeError('Stream benchmark %s failed' % name)
+        results[name] = tuple(json.loads(result))
+    return results
+
+
+def benchmark_bulk_insert(connection_url=None, rows=20000):
+    """
+    Compare the seconds taken to insert rows into a temporary table with
+    executemany, with bulk_insert's COPY and with its multi-row upserts, on
+    connection_url (DATABASE_URL by default).
+    """
+    connection_url = connection_url or os.environ['DATABASE_URL']
+    data = [(i, 'name %d' % i, i * 0.5, Json({'id': i})) for i in range(rows)]
+    database_pool = DatabasePool(connection_url, mincount=1, maxcount=1)
+    results = {}
+    try:
+        with database_pool.cursor(commit_on_close=True) as cur:
+            cur.execute('CREATE TABLE flutil_benchmark (id int PRIMARY KEY, name text, value float8, data jsonb)')
+        try:
+            with database_pool.cursor(commit_on_close=True) as cur:
+                start = time.time()
+                cur.executemany('INSERT INTO flutil_benchmark VALUES (%s, %s, %s, %s)', data)
+                results['executemany'] = time.time() - start
+            for name, on_conflict in (('copy', None), ('upsert', '(id) DO UPDATE SET value = EXCLUDED.value')):
+                with database_pool.cursor(commit_on_close=True) as cur:
+                    cur.execute('TRUNCATE flutil_benchmark')
+                results[name] = database_pool.bulk_insert('flutil_benchmark', ['id', 'name', 'value', 'data'], data,
+                                                          on_conflict=on_conflict).seconds
+        finally:
+            with database_pool.cursor(commit_on_close=True) as cur:
+                cur.execute('DROP TABLE flutil_benchmark')
+    finally:
+        database_pool.close()
+    return results
+
+
+if __name__ == '__main__':
+    for name, seconds in sorted(benchmark().items()):
+        print '%s: %.3fs' % (name, seconds)
+    for name, (rows_per_second, peak_mb) in sorted(benchmark_stream().items()):
+        print '%s: %.0f rows/s, peak RSS +%.1f MB' % (name, rows_per_second, peak_mb)
+    for name, seconds in sorted(benchmark_bulk_insert().items()):
+        print '%s: %.3fs' % (name, seconds)
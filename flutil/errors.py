@@ -1,13 +1,207 @@
+from collections import OrderedDict
 from functools import wraps
+import atexit
 import logging
 import os
+import sys
+import threading
+import time
+import Queue
 
 import bugsnag
+from bugsnag.configuration import RequestConfiguration
+
+from flutil.per_process import PerProcess
+
+try:
+    import flask
+except ImportError:
+    flask = None
 
 bugsnag.configure(api_key=os.getenv('BUGSNAG_API_KEY', ''),
                   project_root=os.getenv('PROJECT_ROOT', '/'),
                   notify_release_stages=[os.getenv('BUGSNAG_RELEASE_STAGE', 'testing')])
 
+LOGGER = logging.getLogger(__name__)
+
+
+def fingerprint(exception, tb=None):
+    """
+    Identify an exception by its type and the code locations of its traceback,
+    but not its message, which often contains ids or values.
+    """
+    frames = []
+    while tb is not None:
+        code = tb.tb_frame.f_code
+        frames.append((code.co_filename, code.co_name, tb.tb_lineno))
+        tb = tb.tb_next
+    return (type(exception).__module__, type(exception).__name__, tuple(frames))
+
+
+def _request_state():
+    """
+    Copy of the calling thread's Bugsnag request configuration, as set by
+    configure_request() and the WSGI middleware, so that reports sent from
+    another thread carry the same request, user and meta data. Details of the
+    Flask request being handled, which bugsnag.flask would add when notifying
+    from the request's thread, are copied into it too.
+    """
+    state = dict((name, dict(value) if isinstance(value, dict) else value)
+                 for name, value in vars(RequestConfiguration.get_instance()).items())
+    if flask is not None and flask.has_request_context():
+        request = flask.request
+        if not state.get('context'):
+            state['context'] = '%s %s' % (request.method, request.path)
+        if not state.get('user_id') and 'id' not in state.get('user', {}):
+            state['user_id'] = request.remote_addr
+        if not state.get('request_data'):
+            state['request_data'] = {
+                'url': request.base_url,
+                'headers': dict(request.headers),
+                'cookies': dict(request.cookies),
+                'params': dict(request.values),
+            }
+        if not state.get('environment_data'):
+            state['environment_data'] = dict(request.environ)
+        if not state.get('session_data'):
+            state['session_data'] = dict(flask.session)
+    return state
+
+
+class _Bucket(object):
+    __slots__ = ('tokens', 'updated_at', 'suppressed')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated_at = now
+        self.suppressed = 0
+
+
+class ErrorReporter(PerProcess):
+    """
+    Sends exceptions to Bugsnag from a background thread, so that failing
+    requests don't wait on building and sending notifications.
+
+    Exceptions are fingerprinted by type and stack, and each fingerprint may
+    be reported at most burst times at once and rate times per second after
+    that. Occurrences over the limit are counted and the count is attached to
+    the next report of the same exception. Reports are dropped when more than
+    max_queued are waiting to be sent.
+
+    - max_fingerprints is the number of distinct exceptions whose limits are tracked
+
+    The request configuration of the reporting thread is copied along with
+    each exception, so reports keep their request, user and meta data.
+
+    Each process gets its own queue and worker, started on first use, so
+    forked workers don't share them. Queued reports are sent at exit.
+    """
+    def __init__(self, rate=0.1, burst=5, max_queued=1000, max_fingerprints=1000, notify=bugsnag.notify):
+        self.rate = rate
+        self.burst = burst
+        self.max_queued = max_queued
+        self.max_fingerprints = max_fingerprints
+        self._notify = notify
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _start_process(self):
+        self._queue = Queue.Queue(self.max_queued)
+        self._buckets = OrderedDict()
+        self.queued = 0
+        self.sent = 0
+        self.suppressed = 0
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name='flutil-errors')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _allow(self, key):
+        """
+        Take a token from the fingerprint's bucket. Returns the number of
+        occurrences suppressed since it was last reported, or None if this
+        one should be suppressed too.
+        """
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                bucket = _Bucket(self.burst, now)
+                while len(self._buckets) >= self.max_fingerprints:
+                    self._buckets.popitem(last=False)
+            else:
+                bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated_at) * self.rate)
+                bucket.updated_at = now
+            # Re-insert to mark as most recently seen.
+            self._buckets[key] = bucket
+            if bucket.tokens < 1:
+                bucket.suppressed += 1
+                self.suppressed += 1
+                return None
+            bucket.tokens -= 1
+            suppressed, bucket.suppressed = bucket.suppressed, 0
+            return suppressed
+
+    def report(self, exception, context=None, tb=None):
+        """
+        Queue an exception to be sent to Bugsnag, with the traceback of the
+        exception being handled unless tb is given.
+        """
+        if self._pid != os.getpid():
+            self._start()
+        if tb is None:
+            tb = sys.exc_info()[2]
+        suppressed = self._allow(fingerprint(exception, tb))
+        if suppressed is None:
+            return
+        try:
+            self._queue.put_nowait((exception, context, tb, suppressed, _request_state()))
+            self.queued += 1
+        except Queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            exception, context, tb, suppressed, request_state = item
+            options = {'context': context, 'traceback': tb}
+            if suppressed:
+                options['meta_data'] = {'occurrences': {'suppressed_since_last_report': suppressed}}
+            vars(RequestConfiguration.get_instance()).update(request_state)
+            try:
+                self._notify(exception, **options)
+                self.sent += 1
+            except Exception:
+                LOGGER.exception('Could not report exception to Bugsnag')
+            finally:
+                RequestConfiguration.clear()
+
+    def stats(self):
+        if self._pid != os.getpid():
+            return {}
+        return {
+            'queued': self.queued,
+            'sent': self.sent,
+            'suppressed': self.suppressed,
+            'dropped': self.dropped,
+            'waiting': self._queue.qsize(),
+        }
+
+    def close(self, timeout=5):
+        """Send whatever is queued, waiting at most timeout seconds."""
+        if self._pid != os.getpid():
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except Queue.Full:
+            return
+        self._thread.join(timeout)
+
+
+_reporter = ErrorReporter()
+
 
 def log_exception(e, context_msg=None):
     if context_msg:
@@ -15,7 +209,7 @@ def log_exception(e, context_msg=None):
     else:
         msg = e.message
 
-    bugsnag.notify(e, context=context_msg)
+    _reporter.report(e, context=context_msg)
     logging.error(msg)
 
 
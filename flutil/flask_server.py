@@ -1,16 +1,243 @@
 import logging
 import argparse
+import httplib
+import os
 import time
 import signal
+import sys
+import threading
+import weakref
+from multiprocessing.pool import ThreadPool
 
+import tornado
+from tornado import escape, httputil, process
 from tornado.wsgi import WSGIContainer
 from tornado.httpserver import HTTPServer
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.netutil import bind_sockets
+
+from flutil import metrics
+from flutil.metrics import Histogram, instrument_app
 
 
 logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
 
 MAX_WAIT_SECONDS_BEFORE_SHUTDOWN = 10
+QUEUE_DEPTH_REPORT_INTERVAL_MS = 5000
+
+
+class ThreadedWSGIContainer(WSGIContainer):
+    """
+    WSGIContainer that runs the WSGI app on a pool of threads, so that a slow
+    request doesn't hold up every other connection of the process. The
+    IOLoop still accepts and parses requests and writes responses.
+
+    Requests beyond the threads busy and max_queued waiting for one are
+    answered straight away with a 503. The number of requests running and
+    waiting is reported as gauges named http.worker_{task id}.busy and
+    http.worker_{task id}.queued. With threads=0, requests run on the IOLoop
+    thread as with WSGIContainer.
+
+    Requests in flight are tracked so that the server can drain them before
+    shutting down. Once draining is set, responses ask clients to close their
+    connection, and requests for readiness_path, if given, get a 503 instead
+    of a 200, so load balancers stop sending new ones.
+    """
+    def __init__(self, wsgi_application, threads=8, max_queued=100, readiness_path=None):
+        super(ThreadedWSGIContainer, self).__init__(wsgi_application)
+        self.threads = threads
+        self.max_queued = max_queued
+        self.readiness_path = readiness_path
+        self.draining = False
+        self.pending = 0
+        self.busy = 0
+        self.rejected = 0
+        self._busy_lock = threading.Lock()
+        self._pool = None
+        self._stopping = False
+        # Streams of the connections with requests in flight, and how many each.
+        self._streams = {}
+        self._reporter = None
+
+    def start(self):
+        """Start the threads, once the process has been forked."""
+        if not self.threads:
+            return
+        self._pool = ThreadPool(self.threads)
+        task_id = process.task_id()
+        self._metrics_prefix = 'http.worker_{}'.format(task_id if task_id is not None else 0)
+        self._reporter = PeriodicCallback(self.report, QUEUE_DEPTH_REPORT_INTERVAL_MS)
+        self._reporter.start()
+
+    def stop(self):
+        """Stop taking new requests off the queue once those pending have finished."""
+        self._stopping = True
+        if self._reporter is not None:
+            self._reporter.stop()
+        if self._pool is not None:
+            self._pool.close()
+
+    def report(self):
+        metrics.gauge(self._metrics_prefix + '.busy', self.busy)
+        metrics.gauge(self._metrics_prefix + '.queued', self.pending - self.busy)
+
+    def close_idle_connections(self, streams):
+        """Close the keep-alive connections among idle streams that have no request in flight."""
+        for stream in list(streams):
+            if stream not in self._streams:
+                stream.close()
+
+    def __call__(self, request):
+        if self.readiness_path is not None and request.path == self.readiness_path:
+            if self.draining:
+                self._write_response(request, '503 Service Unavailable', [], b'Draining')
+            else:
+                self._write_response(request, '200 OK', [], b'OK')
+            return
+        if self.threads and (self._stopping or self.pending >= self.threads + self.max_queued):
+            self.rejected += 1
+            self._write_response(request, '503 Service Unavailable', [('Retry-After', '1')], b'Service Unavailable')
+            return
+
+        self.pending += 1
+        stream = request.connection.stream
+        self._streams[stream] = self._streams.get(stream, 0) + 1
+        environ = WSGIContainer.environ(request)
+        if self._pool is None:
+            self._finish(request, self._run(environ))
+            return
+        environ['wsgi.multithread'] = True
+        io_loop = IOLoop.current()
+        self._pool.apply_async(self._run, (environ,),
+                               callback=lambda result: io_loop.add_callback(self._finish, request, result))
+
+    def _run(self, environ):
+        # Runs on a pool thread.
+        with self._busy_lock:
+            self.busy += 1
+        data = {}
+        response = []
+
+        def start_response(status, response_headers, exc_info=None):
+            data['status'] = status
+            data['headers'] = response_headers
+            return response.append
+
+        try:
+            app_response = self.wsgi_application(environ, start_response)
+            try:
+                response.extend(app_response)
+            finally:
+                if hasattr(app_response, 'close'):
+                    app_response.close()
+            if not data:
+                raise Exception('WSGI app did not call start_response')
+            return data['status'], data['headers'], b''.join(response)
+        except Exception:
+            logging.error('Uncaught exception in WSGI app', exc_info=True)
+            return '500 Internal Server Error', [], b'Internal Server Error'
+        finally:
+            with self._busy_lock:
+                self.busy -= 1
+
+    def _finish(self, request, result):
+        self.pending -= 1
+        stream = request.connection.stream
+        count = self._streams.pop(stream) - 1
+        if count:
+            self._streams[stream] = count
+        status, headers, body = result
+        if self.draining:
+            headers.append(('Connection', 'close'))
+        self._write_response(request, status, headers, body)
+
+    def _write_response(self, request, status, headers, body):
+        # As WSGIContainer.__call__ does.
+        status_code = int(status.split()[0])
+        header_set = set(k.lower() for (k, v) in headers)
+        body = escape.utf8(body)
+        if status_code != 304:
+            if 'content-length' not in header_set:
+                headers.append(('Content-Length', str(len(body))))
+            if 'content-type' not in header_set:
+                headers.append(('Content-Type', 'text/html; charset=UTF-8'))
+        if 'server' not in header_set:
+            headers.append(('Server', 'TornadoServer/%s' % tornado.version))
+
+        parts = [escape.utf8('HTTP/1.1 ' + status + '\r\n')]
+        for key, value in headers:
+            parts.append(escape.utf8(key) + b': ' + escape.utf8(value) + b'\r\n')
+        parts.append(b'\r\n')
+        parts.append(body)
+        request.write(b''.join(parts))
+        request.finish()
+        self._log(status_code, request)
+
+
+class _ReceivingRequest(httputil.HTTPMessageDelegate):
+    """
+    Request delegate that marks its stream as receiving from the end of the
+    request's headers until the whole body has arrived and been handed on.
+    """
+    def __init__(self, receiving, stream, delegate):
+        self._receiving = receiving
+        self._stream = stream
+        self._delegate = delegate
+
+    def headers_received(self, start_line, headers):
+        self._receiving.add(self._stream)
+        return self._delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        return self._delegate.data_received(chunk)
+
+    def finish(self):
+        self._receiving.discard(self._stream)
+        return self._delegate.finish()
+
+    def on_connection_close(self):
+        self._receiving.discard(self._stream)
+        return self._delegate.on_connection_close()
+
+
+class DrainingHTTPServer(HTTPServer):
+    """
+    HTTPServer that keeps track of the streams of its open connections, and
+    of those receiving a request, so that idle ones can be closed when
+    draining and the server can wait for the rest.
+    """
+    def __init__(self, *args, **kwargs):
+        super(DrainingHTTPServer, self).__init__(*args, **kwargs)
+        self.streams = weakref.WeakSet()
+        self.receiving = weakref.WeakSet()
+
+    def handle_stream(self, stream, address):
+        self.streams.add(stream)
+        super(DrainingHTTPServer, self).handle_stream(stream, address)
+
+    def start_request(self, server_conn, request_conn):
+        delegate = super(DrainingHTTPServer, self).start_request(server_conn, request_conn)
+        return _ReceivingRequest(self.receiving, request_conn.stream, delegate)
+
+    def idle_streams(self):
+        """Open streams between requests: neither receiving one nor writing a response."""
+        return [stream for stream in self.streams
+                if not stream.closed() and stream not in self.receiving and not stream.writing()]
+
+    def busy(self):
+        """Whether any connection is still receiving a request or writing a response."""
+        return any(not stream.closed() and (stream in self.receiving or stream.writing())
+                   for stream in self.streams)
+
+
+def _pool_manager():
+    """
+    flutil.db's PoolManager if the service has loaded it, so that services
+    without a database don't need psycopg2. Pools are made by importing
+    flutil.db, so there are none to hook around forks otherwise.
+    """
+    db = sys.modules.get('flutil.db')
+    return db.PoolManager if db is not None else None
 
 
 def start_service(app, service_name):
@@ -18,41 +245,197 @@ def start_service(app, service_name):
     parser.add_argument('-p', '--port', default=8080, required=False, type=int)
     parser.add_argument('-d', '--debug', default=False, action='store_true', required=False)
     parser.add_argument('-n', '--num_processes', default=None, type=int, required=False)
+    parser.add_argument('-w', '--warm_pools', default=False, action='store_true', required=False,
+                        help='open database pool connections as soon as each worker starts')
+    parser.add_argument('--no_request_metrics', default=False, action='store_true', required=False,
+                        help="don't record latency, status and size metrics for every request")
+    parser.add_argument('-t', '--threads', default=0, type=int, required=False,
+                        help='run requests on this many threads per process instead of the IOLoop thread')
+    parser.add_argument('--max_queued', default=100, type=int, required=False,
+                        help='with --threads, requests waiting for a thread beyond which to answer 503')
+    parser.add_argument('--drain_seconds', default=MAX_WAIT_SECONDS_BEFORE_SHUTDOWN, type=float, required=False,
+                        help='on SIGTERM, how long to wait for requests in flight before exiting')
+    parser.add_argument('--drain_delay', default=0, type=float, required=False,
+                        help='on SIGTERM, how long to keep accepting requests while readiness checks fail')
+    parser.add_argument('--readiness_path', default=None, required=False,
+                        help='path answering 200, or 503 once draining, e.g. /ready')
     args = parser.parse_args()
 
+    if not args.no_request_metrics:
+        instrument_app(app)
+
     if args.debug:
         app.run('0.0.0.0', args.port, args.debug, threaded=True)
     else:
-        http_server = HTTPServer(WSGIContainer(app))
+        container = ThreadedWSGIContainer(app, args.threads, args.max_queued, args.readiness_path)
+        http_server = DrainingHTTPServer(container)
+        # The parent closes the write end on SIGTERM, telling every worker to drain.
+        lifeline = list(os.pipe())
+        is_worker = [False]
 
         def shutdown():
+            if container.draining:
+                return
+            container.draining = True
+            logging.info('Draining %d requests in flight', container.pending)
+            IOLoop.current().add_timeout(time.time() + args.drain_delay, stop_accepting)
+
+        def stop_accepting():
             logging.info('Stopping http server')
             http_server.stop()
 
-            logging.info('Forcing shutdown in %s seconds ...',
-                         MAX_WAIT_SECONDS_BEFORE_SHUTDOWN)
-            io_loop = IOLoop.instance()
+            logging.info('Forcing shutdown in %s seconds ...', args.drain_seconds)
+            io_loop = IOLoop.current()
+            deadline = time.time() + args.drain_seconds
 
-            deadline = time.time() + MAX_WAIT_SECONDS_BEFORE_SHUTDOWN
+            def wait_for_requests():
+                container.close_idle_connections(http_server.idle_streams())
+                # Responses may still be in the streams' write buffers once requests are done.
+                if (container.pending or http_server.busy()) and time.time() < deadline:
+                    io_loop.add_timeout(time.time() + 0.1, wait_for_requests)
+                    return
+                if container.pending or http_server.busy():
+                    logging.warning('Shutting down with %d requests in flight', container.pending)
+                container.stop()
+                io_loop.stop()
+                logging.info('Shutdown')
+            wait_for_requests()
 
-            def stop_loop():
-                now = time.time()
-                if now < deadline and (io_loop._callbacks or io_loop._timeouts):
-                    io_loop.add_timeout(now + 1, stop_loop)
-                else:
-                    io_loop.stop()
-                    logging.info('Shutdown')
-            stop_loop()
+        def on_parent_shutdown(fd, events):
+            IOLoop.current().remove_handler(fd)
+            os.close(fd)
+            shutdown()
 
         def sig_handler(sig, frame):
             logging.warning('Caught signal: %s', sig)
-            IOLoop.instance().add_callback(shutdown)
+            if is_worker[0]:
+                IOLoop.current().add_callback_from_signal(shutdown)
+            elif lifeline[1] is not None:
+                # Forward to the workers, then wait for them to exit.
+                os.close(lifeline[1])
+                lifeline[1] = None
 
         signal.signal(signal.SIGTERM, sig_handler)
         signal.signal(signal.SIGINT, sig_handler)
 
         http_server.bind(args.port)
+        pool_manager = _pool_manager()
+        if pool_manager is not None:
+            pool_manager.before_fork()
         http_server.start(args.num_processes)  # Forks multiple sub-processes
+        # Returns in each worker, or in the only process when not forking.
+        is_worker[0] = True
+        if lifeline[1] is None:
+            # fork_processes restarts workers that exit with an error, even once
+            # the parent has started shutting down. Exit cleanly so it stops.
+            logging.info('Shutting down, not restarting worker %s', process.task_id())
+            sys.exit(0)
+        os.close(lifeline[1])
+        lifeline[1] = None
+        if process.task_id() is not None:
+            IOLoop.current().add_handler(lifeline[0], on_parent_shutdown, IOLoop.READ)
+        else:
+            os.close(lifeline[0])
+        if pool_manager is not None:
+            pool_manager.after_fork(warm_up=args.warm_pools)
+        container.start()
         IOLoop.current().start()
 
         logging.info('Goodbye')
+
+
+def benchmark(requests=320, clients=32, service_ms=(0, 50), thread_counts=(0, 16)):
+    """
+    Load test a ThreadedWSGIContainer in this process: clients keep-alive
+    connections share requests to a WSGI app that waits service_ms on each,
+    as it would on a database, for each of service_ms and thread_counts
+    (0 runs requests on the IOLoop thread). Returns requests per second,
+    latency percentiles in ms and errors by (service_ms, threads).
+    """
+    access_log = logging.getLogger('tornado.access')
+    access_level = access_log.level
+    access_log.setLevel(logging.WARNING)
+    results = {}
+    try:
+        for ms in service_ms:
+            def app(environ, start_response, seconds=ms / 1000.0):
+                if seconds:
+                    time.sleep(seconds)
+                start_response('200 OK', [('Content-Type', 'text/plain')])
+                return [b'OK']
+
+            for threads in thread_counts:
+                results[(ms, threads)] = _load_test(app, requests, clients, threads)
+    finally:
+        access_log.setLevel(access_level)
+    return results
+
+
+def _load_test(app, requests, clients, threads):
+    container = ThreadedWSGIContainer(app, threads, max_queued=clients)
+    io_loop = IOLoop()
+    server = HTTPServer(container, io_loop=io_loop)
+    sockets = bind_sockets(0, '127.0.0.1')
+    port = sockets[0].getsockname()[1]
+    server.add_sockets(sockets)
+
+    def serve():
+        io_loop.make_current()
+        container.start()
+        io_loop.start()
+
+    server_thread = threading.Thread(target=serve, name='flutil-benchmark-server')
+    server_thread.start()
+
+    remaining = [requests]
+    lock = threading.Lock()
+    latencies = Histogram()
+    errors = [0]
+
+    def client():
+        histogram = Histogram()
+        failed = 0
+        connection = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+        while True:
+            with lock:
+                if not remaining[0]:
+                    break
+                remaining[0] -= 1
+            started = time.time()
+            try:
+                connection.request('GET', '/')
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    failed += 1
+            except (httplib.HTTPException, IOError):
+                failed += 1
+                connection.close()
+            histogram.record((time.time() - started) * 1000)
+        connection.close()
+        with lock:
+            latencies.merge(histogram)
+            errors[0] += failed
+
+    started = time.time()
+    client_threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in client_threads:
+        thread.start()
+    for thread in client_threads:
+        thread.join()
+    seconds = time.time() - started
+
+    io_loop.add_callback(server.stop)
+    io_loop.add_callback(container.stop)
+    io_loop.add_callback(io_loop.stop)
+    server_thread.join()
+    io_loop.close(all_fds=True)
+
+    p50, p99 = latencies.percentiles(0.5, 0.99)
+    return {'requests_per_second': requests / seconds, 'p50_ms': p50, 'p99_ms': p99, 'errors': errors[0]}
+
+
+if __name__ == '__main__':
+    for (ms, threads), result in sorted(benchmark().items()):
+        print '%d ms handler, %d threads: %.0f req/s, p50 %.1f ms, p99 %.1f ms, %d errors' % (
+            ms, threads, result['requests_per_second'], result['p50_ms'], result['p99_ms'], result['errors'])
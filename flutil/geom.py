@@ -1,4 +1,17 @@
+import itertools
 import json
+import random
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# bounding_box bounds geometries with fewer positions in plain Python, which
+# is faster than converting them to arrays one at a time.
+NUMPY_MIN_POSITIONS = 1000
+
 
 class Point(object):
     def __init__(self, **geometry):
@@ -18,7 +31,145 @@ class Point(object):
     def json(self):
         return json.dumps(self.geodict)
 
+def _paths(geom):
+    """
+    Yield the lists of positions making up a GeoJSON geometry, feature or
+    feature collection.
+    """
+    kind = geom['type']
+    if kind == 'FeatureCollection':
+        for feature in geom['features']:
+            for path in _paths(feature):
+                yield path
+    elif kind == 'Feature':
+        if geom.get('geometry'):
+            for path in _paths(geom['geometry']):
+                yield path
+    elif kind == 'GeometryCollection':
+        for geometry in geom['geometries']:
+            for path in _paths(geometry):
+                yield path
+    elif kind == 'Point':
+        if geom['coordinates']:
+            yield [geom['coordinates']]
+    elif kind in ('MultiPoint', 'LineString'):
+        if geom['coordinates']:
+            yield geom['coordinates']
+    elif kind in ('MultiLineString', 'Polygon'):
+        for path in geom['coordinates']:
+            if path:
+                yield path
+    elif kind == 'MultiPolygon':
+        for polygon in geom['coordinates']:
+            for path in polygon:
+                if path:
+                    yield path
+    else:
+        raise ValueError('Unknown GeoJSON type %r' % kind)
+
+
+def _box(lon_min, lat_min, lon_max, lat_max):
+    return {'lat_min': float(lat_min),
+            'lat_max': float(lat_max),
+            'lon_min': float(lon_min),
+            'lon_max': float(lon_max)}
+
+
+def _scan_bounds(paths):
+    # Bounds of lists of positions in plain Python.
+    bounds = None
+    for path in paths:
+        if len(path) < NUMPY_MIN_POSITIONS:
+            # Transposing a short path is cheap, and lets min and max run in C.
+            columns = zip(*path)
+            path_bounds = (min(columns[0]), min(columns[1]), max(columns[0]), max(columns[1]))
+        else:
+            # Scan long ones without copying them.
+            path_bounds = (min(p[0] for p in path), min(p[1] for p in path),
+                           max(p[0] for p in path), max(p[1] for p in path))
+        if bounds is None:
+            bounds = path_bounds
+        else:
+            bounds = (min(bounds[0], path_bounds[0]), min(bounds[1], path_bounds[1]),
+                      max(bounds[2], path_bounds[2]), max(bounds[3], path_bounds[3]))
+    return bounds
+
+
+def _positions_array(paths, count):
+    """
+    (count, 2) array of the longitudes and latitudes of the count positions
+    of paths, read straight from the positions rather than through
+    numpy.array, which is several times slower on nested lists. Positions may
+    carry an altitude, which doesn't count towards the bounds.
+    """
+    dimensions = len(paths[0][0])
+    if any(len(path[0]) != dimensions for path in paths):
+        # Some paths carry an altitude and others don't.
+        return numpy.concatenate([_positions_array([path], len(path)) for path in paths])
+    coordinates = itertools.chain.from_iterable(itertools.chain.from_iterable(paths))
+    try:
+        values = numpy.fromiter(coordinates, float, count * dimensions)
+    except ValueError:
+        values = None
+    if values is None or next(coordinates, None) is not None:
+        raise ValueError('Positions of a path must all have the same number of dimensions')
+    return values.reshape(-1, dimensions)[:, :2]
+
+
 def bounding_box(geom):
+    """
+    Bounds of any GeoJSON geometry, feature or feature collection, as a dict
+    of lat_min, lat_max, lon_min and lon_max, or None if it has no positions.
+    """
+    paths = list(_paths(geom))
+    if not paths:
+        return None
+    count = sum(len(path) for path in paths)
+    if numpy is None or count < NUMPY_MIN_POSITIONS:
+        return _box(*_scan_bounds(paths))
+    positions = _positions_array(paths, count)
+    lon_min, lat_min = positions.min(axis=0)
+    lon_max, lat_max = positions.max(axis=0)
+    return _box(lon_min, lat_min, lon_max, lat_max)
+
+
+def bounding_boxes(geoms):
+    """
+    bounding_box of each of a sequence of GeoJSON objects. With numpy, the
+    positions of all of them are read into one array and bounded in one
+    pass, which beats bounding small geometries one at a time.
+    """
+    geom_paths = [list(_paths(geom)) for geom in geoms]
+    if numpy is None:
+        return [_box(*_scan_bounds(paths)) if paths else None for paths in geom_paths]
+
+    boxes = [None] * len(geom_paths)
+    paths = []
+    # Offset in positions of each geometry with any, and its index in boxes.
+    offsets = []
+    indexes = []
+    count = 0
+    for i, each in enumerate(geom_paths):
+        if each:
+            offsets.append(count)
+            indexes.append(i)
+            paths.extend(each)
+            for path in each:
+                count += len(path)
+    if paths:
+        positions = _positions_array(paths, count)
+        # One flat list per column: a list per geometry would keep the garbage
+        # collector busy on large batches of small geometries.
+        lon_mins, lat_mins = numpy.minimum.reduceat(positions, offsets).T.tolist()
+        lon_maxs, lat_maxs = numpy.maximum.reduceat(positions, offsets).T.tolist()
+        for j, i in enumerate(indexes):
+            boxes[i] = {'lat_min': lat_mins[j], 'lat_max': lat_maxs[j],
+                        'lon_min': lon_mins[j], 'lon_max': lon_maxs[j]}
+    return boxes
+
+
+def _list_bounding_box(geom):
+    # The implementation bounding_box replaced, for comparison.
     if geom['type'] == 'MultiPolygon':
         vertices = [point for poly in geom['coordinates'] for shape in poly for point in shape]
     else:
@@ -29,3 +180,34 @@ def bounding_box(geom):
             'lat_max': max(lats),
             'lon_min': min(lons),
             'lon_max': max(lons)}
+
+
+def benchmark(points=200000, fields=1000, field_points=200, seed=0):
+    """
+    Compare the seconds taken to bound one polygon of the given number of
+    points, and a collection of fields, with the list based implementation,
+    bounding_box and bounding_boxes.
+    """
+    rng = random.Random(seed)
+
+    def polygon(n):
+        ring = [[rng.uniform(-90, -80), rng.uniform(40, 45)] for _ in range(n - 1)]
+        return {'type': 'Polygon', 'coordinates': [ring + ring[:1]]}
+
+    def timed(function, *args):
+        start = time.time()
+        function(*args)
+        return time.time() - start
+
+    large = polygon(points)
+    many = [polygon(field_points) for _ in range(fields)]
+    return {
+        'lists': (timed(_list_bounding_box, large), timed(map, _list_bounding_box, many)),
+        'bounding_box': (timed(bounding_box, large), timed(map, bounding_box, many)),
+        'bounding_boxes': (timed(bounding_boxes, [large]), timed(bounding_boxes, many)),
+    }
+
+
+if __name__ == '__main__':
+    for name, (large, many) in sorted(benchmark().items()):
+        print '%s: %.1f ms for one large polygon, %.1f ms for many fields' % (name, large * 1e3, many * 1e3)
@@ -0,0 +1,44 @@
+import os
+import threading
+
+# One lock per process, created in that process, guarding PerProcess starts.
+_start_locks = {}
+
+
+def _start_lock():
+    pid = os.getpid()
+    lock = _start_locks.get(pid)
+    if lock is None:
+        # setdefault is atomic, so racing threads end up with the same lock.
+        lock = _start_locks.setdefault(pid, threading.Lock())
+    return lock
+
+
+class PerProcess(object):
+    """
+    Base for objects holding state that must not be shared between forked
+    processes, such as a buffer and the background thread draining it.
+
+    Subclasses implement _start_process() to set up that state, and call
+    _start() before using it whenever self._pid isn't the current process:
+
+        if self._pid != os.getpid():
+            self._start()
+
+    _start_process() runs once in each process, with a fresh self._lock: a
+    lock inherited across fork may have been held by a thread of the parent
+    at the time, and would never be released in the child.
+    """
+    _pid = None
+
+    def _start(self):
+        with _start_lock():
+            pid = os.getpid()
+            if self._pid == pid:
+                return
+            self._lock = threading.Lock()
+            self._start_process()
+            self._pid = pid
+
+    def _start_process(self):
+        raise NotImplementedError
@@ -0,0 +1,178 @@
+import hashlib
+import threading
+import zlib
+from functools import wraps
+
+from flask import current_app, request
+
+from flutil.cache import LRUCache, estimate_size
+
+# Set on the environ of requests answered from the cache, so they aren't stored again.
+HIT_ENVIRON_KEY = 'flutil.response_cache.hit'
+# Where init_app registers the ResponseCache of an app, for cached views to find it.
+EXTENSION_KEY = 'flutil.response_cache'
+COMPRESSIBLE_TYPES = frozenset(['application/json', 'application/javascript', 'application/xml',
+                                'application/geo+json', 'image/svg+xml'])
+# Headers that depend on the representation sent, rather than the response.
+_VARIANT_HEADERS = frozenset(['content-length', 'content-encoding', 'etag'])
+
+
+def cached(ttl=60):
+    """
+    Cache the responses of a view for ttl seconds, by path and query string,
+    when it is served through a ResponseCache. Only successful GET and HEAD
+    requests are cached.
+
+    Cached responses are served in place of calling the view, after the app's
+    before_request handlers have run, so handlers that reject a request (e.g.
+    authentication) still apply to hits. Place this decorator below Flask's
+    @app.route decorator.
+    """
+    def decorator(view):
+        @wraps(view)
+        def cached_view(*args, **kwargs):
+            response_cache = current_app.extensions.get(EXTENSION_KEY)
+            if response_cache is not None:
+                response = response_cache._cached_response()
+                if response is not None:
+                    return response
+            return view(*args, **kwargs)
+
+        cached_view.response_cache_ttl = ttl
+        return cached_view
+    return decorator
+
+
+class _CachedResponse(object):
+    __slots__ = ('headers', 'body', 'gzipped', 'etag')
+
+    def __init__(self, headers, body, gzipped, etag):
+        self.headers = headers
+        self.body = body
+        self.gzipped = gzipped
+        self.etag = etag
+
+
+def _entry_size(entry):
+    return estimate_size(entry.headers) + len(entry.body) + len(entry.gzipped or '') + len(entry.etag)
+
+
+class ResponseCache(object):
+    """
+    Adds to every successful GET or HEAD response of a Flask app an ETag,
+    answering requests whose If-None-Match matches it with a 304, and gzips
+    bodies of at least min_compress_bytes for clients that accept it.
+    Responses of views decorated with cached() are also kept in an LRUCache,
+    with both the plain and the gzipped body, so repeated hits neither call
+    the view nor compress again.
+
+    - cache is the LRUCache to keep responses in, by default bounded to 1024
+      responses and 64MB
+    - compress_level is the zlib compression level, from 1 (fastest) to 9
+
+    Streamed responses are passed through untouched. Cached responses of a
+    view can be dropped with invalidate(endpoint).
+    """
+    def __init__(self, app=None, cache=None, min_compress_bytes=1024, compress_level=6):
+        self.cache = cache or LRUCache(sizeof=_entry_size)
+        self.min_compress_bytes = min_compress_bytes
+        self.compress_level = compress_level
+        self._lock = threading.Lock()
+        self.responses = 0
+        self.not_modified = 0
+        self.compressed = 0
+        self.bytes_saved = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions[EXTENSION_KEY] = self
+        app.after_request(self._after_request)
+
+    def invalidate(self, *endpoints):
+        self.cache.invalidate(*endpoints)
+
+    def stats(self):
+        stats = self.cache.stats()
+        lookups = stats['hits'] + stats['misses']
+        with self._lock:
+            stats.update({
+                'hit_ratio': float(stats['hits']) / lookups if lookups else None,
+                'responses': self.responses,
+                'not_modified': self.not_modified,
+                'compressed': self.compressed,
+                'bytes_saved': self.bytes_saved,
+            })
+        return stats
+
+    def _cache_key(self):
+        if request.method not in ('GET', 'HEAD'):
+            return None, None
+        view = current_app.view_functions.get(request.endpoint)
+        ttl = getattr(view, 'response_cache_ttl', None)
+        if ttl is None:
+            return None, None
+        return (request.endpoint, request.path, tuple(sorted(request.args.items(multi=True)))), ttl
+
+    def _cached_response(self):
+        key, _ = self._cache_key()
+        if key is None:
+            return None
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        request.environ[HIT_ENVIRON_KEY] = True
+        return self._respond(entry)
+
+    def _after_request(self, response):
+        if request.environ.get(HIT_ENVIRON_KEY) or request.method not in ('GET', 'HEAD') \
+                or response.status_code != 200 or response.is_streamed or response.direct_passthrough \
+                or 'Content-Encoding' in response.headers:
+            return response
+
+        body = response.get_data()
+        gzipped = None
+        if len(body) >= self.min_compress_bytes and self._compressible(response.mimetype):
+            compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            gzipped = compressor.compress(body) + compressor.flush()
+            if len(gzipped) >= len(body):
+                gzipped = None
+        headers = [(k, v) for k, v in response.headers if k.lower() not in _VARIANT_HEADERS]
+        entry = _CachedResponse(headers, body, gzipped, hashlib.md5(body).hexdigest())
+
+        key, ttl = self._cache_key()
+        cache_control = response.headers.get('Cache-Control', '')
+        if key is not None and 'Set-Cookie' not in response.headers \
+                and 'no-store' not in cache_control and 'private' not in cache_control:
+            self.cache.set(key, entry, ttl, tags=(request.endpoint,))
+        return self._respond(entry)
+
+    def _compressible(self, mimetype):
+        return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES \
+            or mimetype.endswith('+json') or mimetype.endswith('+xml')
+
+    def _respond(self, entry):
+        """Build the response for the current request from a cached one."""
+        response = current_app.response_class(status=200, headers=entry.headers)
+        response.set_etag(entry.etag, weak=True)
+        # Keep whatever the view itself varies on, e.g. Origin.
+        response.vary.add('Accept-Encoding')
+        saved = 0
+        if request.if_none_match.contains_weak(entry.etag):
+            response.status_code = 304
+            saved = len(entry.body)
+        elif entry.gzipped is not None and request.accept_encodings['gzip']:
+            response.set_data(entry.gzipped)
+            response.headers['Content-Encoding'] = 'gzip'
+            saved = len(entry.body) - len(entry.gzipped)
+        else:
+            response.set_data(entry.body)
+
+        with self._lock:
+            self.responses += 1
+            if response.status_code == 304:
+                self.not_modified += 1
+            elif saved:
+                self.compressed += 1
+            self.bytes_saved += saved
+        return response
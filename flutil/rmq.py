@@ -1,21 +1,439 @@
+import errno
+import fcntl
+import json
 import logging
+import multiprocessing
+import os
 import pika
+import random
+import re
+import threading
 import time
+import traceback
+from collections import deque
+from copy import copy
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from pika.adapters.select_connection import READ
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
                       '-35s %(lineno) -5d: %(message)s')
 LOGGER = logging.getLogger(__name__)
 
-# Exception that should be thrown in your callback to requeue the message when it fails
+# Exception that should be thrown in your callback to requeue the message when it fails.
+# With a RetryPolicy, pass delay=seconds to override the backoff delay for this retry.
 class RetryException(Exception):
-    pass
+    def __init__(self, *args, **kwargs):
+        self.delay = kwargs.pop('delay', None)
+        Exception.__init__(self, *args)
+
+    def __reduce__(self):
+        return (_retry_exception, (self.args, self.delay))
+
+
+def _retry_exception(args, delay):
+    return RetryException(*args, delay=delay)
 
 # Exception that should be thrown in your callback to reject the message.
 class RejectException(Exception):
     pass
 
+# Exception that should be thrown in your batch callback to retry or reject some of the messages
+# in the batch. failures maps the index of a message in the batch to a RetryException or
+# RejectException; the other messages are acknowledged.
+class BatchException(Exception):
+    def __init__(self, failures):
+        Exception.__init__(self, failures)
+        self.failures = failures
+
+# Exception raised by Publisher.publish when the confirm window stays full for longer than the timeout.
+class PublishTimeoutException(Exception):
+    pass
+
+# Exception raised by Publisher.publish once the publisher has stopped running.
+class PublisherNotRunningException(Exception):
+    pass
+
+# Outcomes of running a message callback. Each outcome is a (kind, retry delay) pair.
+ACK = 'ack'
+RETRY = 'retry'
+REJECT = 'reject'
+ERROR = 'error'
+
+
+def _outcome(exception):
+    if isinstance(exception, RejectException):
+        return REJECT, None
+    return RETRY, getattr(exception, 'delay', None)
+
+
+def _run_callback(callback, *args):
+    """Run a message callback and return its outcome. Unexpected exceptions
+    propagate to the caller."""
+    try:
+        callback(*args)
+    except (RetryException, RejectException) as e:
+        return _outcome(e)
+    return ACK, None
+
+
+def _run_batch_callback(callback, messages):
+    """Run a batch callback and return the outcome of each message. Unexpected
+    exceptions propagate to the caller."""
+    try:
+        callback(messages)
+    except BatchException as e:
+        outcomes = [(ACK, None)] * len(messages)
+        for index, failure in e.failures.items():
+            outcomes[index] = _outcome(failure)
+        return outcomes
+    except (RetryException, RejectException) as e:
+        return [_outcome(e)] * len(messages)
+    return [(ACK, None)] * len(messages)
+
+
+def _invoke(callback, messages, batch, decoders=None):
+    """Decode a list of (properties, body) messages with the matching
+    decoders, if any, and pass them to a message or batch callback, returning
+    the outcome of each message. Messages that can't be decoded are rejected
+    without reaching the callback."""
+    outcomes = [None] * len(messages)
+    if decoders:
+        decoded = []
+        indexes = []
+        for index, ((properties, body), decoder) in enumerate(zip(messages, decoders)):
+            try:
+                decoded.append((properties, decoder(body)))
+                indexes.append(index)
+            except Exception as e:
+                LOGGER.warning('Could not decode %s message, rejecting it: %s', properties.content_type, e)
+                outcomes[index] = (REJECT, None)
+    else:
+        decoded = messages
+        indexes = range(len(messages))
+
+    if decoded:
+        if batch:
+            results = _run_batch_callback(callback, decoded)
+        else:
+            results = [_run_callback(callback, *decoded[0])]
+        for index, result in zip(indexes, results):
+            outcomes[index] = result
+    return outcomes
+
+
+def _run_pooled_callback(callback, messages, batch, decoders=None):
+    """Run a message or batch callback on a worker, returning the outcome of
+    each message along with the traceback of any unexpected exception. This is
+    a module level function so that it can be pickled for process pools."""
+    try:
+        return _invoke(callback, messages, batch, decoders), None
+    except Exception:
+        return [(ERROR, None)] * len(messages), traceback.format_exc()
+
+
+def decode_json(body):
+    return json.loads(body)
+
+
+def decode_msgpack(body):
+    if msgpack is None:
+        raise RuntimeError('msgpack is not installed')
+    return msgpack.unpackb(body)
+
+
+def decode_raw(body):
+    """Pass the body through as a memoryview, without copying it."""
+    return memoryview(body)
+
+
+class Codec(object):
+    """
+    Picks a decoder for each message from its content_type, so callbacks
+    receive decoded objects rather than raw bodies.
+
+    - decoders maps media types to decoding functions, extending or overriding
+      the defaults for JSON and msgpack. use module level functions with a
+      process pool, so they can be pickled.
+    - default is the decoder for any other content type
+
+    """
+    DECODERS = {
+        'application/json': decode_json,
+        'application/msgpack': decode_msgpack,
+        'application/x-msgpack': decode_msgpack,
+    }
+
+    def __init__(self, decoders=None, default=decode_raw):
+        self._decoders = dict(self.DECODERS)
+        self._decoders.update(decoders or {})
+        self._default = default
+        self._cache = {}
+
+    def decoder_for(self, content_type):
+        try:
+            return self._cache[content_type]
+        except KeyError:
+            media_type = (content_type or '').split(';')[0].strip().lower()
+            decoder = self._cache[content_type] = self._decoders.get(media_type, self._default)
+            return decoder
+
+
+class _LazyBody(object):
+    """
+    Message body for log records, only formatted (and truncated) if the
+    record is actually emitted.
+    """
+    __slots__ = ('body', 'limit')
+
+    def __init__(self, body, limit):
+        self.body = body
+        self.limit = limit
+
+    def __str__(self):
+        if self.limit is not None and len(self.body) > self.limit:
+            return '%s... (%d bytes)' % (self.body[:self.limit], len(self.body))
+        return str(self.body)
+
+
+# Header counting how many times a message has been retried under a RetryPolicy.
+RETRY_COUNT_HEADER = 'x-retry-count'
+
+
+class _ConsumerStats(object):
+    """
+    Counters and timings kept by a Consumer when instrumentation is enabled.
+    Only touched on the IOLoop thread.
+    """
+    def __init__(self):
+        from flutil.metrics import Histogram
+        self.started_at = time.time()
+        self.received = 0
+        self.outcomes = {ACK: 0, RETRY: 0, REJECT: 0, ERROR: 0}
+        self.latency_ms = Histogram()
+        self.reconnects = 0
+        self.reconnect_seconds = 0.0
+        self.disconnected_at = None
+        self.queue_depth = None
+        self.queue_consumers = None
+        self._last_at = self.started_at
+        self._last_received = 0
+        self._last_reported = {}
+
+    def rate(self):
+        """Messages received per second since the previous call."""
+        now = time.time()
+        elapsed = now - self._last_at
+        rate = (self.received - self._last_received) / elapsed if elapsed > 0 else 0.0
+        self._last_at = now
+        self._last_received = self.received
+        return rate
+
+    def deltas(self, counters):
+        """Increase of each counter since the previous call, for statsd."""
+        deltas = {}
+        for key, value in counters.items():
+            deltas[key] = value - self._last_reported.get(key, 0)
+            self._last_reported[key] = value
+        return deltas
+
+
+class RetryPolicy(object):
+    """
+    Retries failed messages after an exponentially growing, jittered delay,
+    rather than requeueing them at the head of the queue straight away.
+
+    Retried messages are published with a per-message TTL to one of a tier of
+    delay queues, each dead-lettering into the consumer's queue, so they come
+    back once their delay has passed. Each tier holds messages with similar
+    delays, so a long delay never holds up a short one behind it.
+
+    - base_delay is the number of seconds to wait before the first retry
+    - multiplier is the factor the delay grows by with each attempt
+    - max_delay is the longest delay, in seconds
+    - jitter is the fraction of the delay randomly taken off, to spread retries out
+    - max_attempts is the number of retries after which a message is moved to
+      the parking queue instead
+    - parking_queue defaults to '<queue>.parked'
+
+    Raise RetryException(delay=seconds) to pick the delay of a single retry.
+
+    """
+    def __init__(self, base_delay=1, multiplier=2, max_delay=300, jitter=0.5, max_attempts=10, parking_queue=None):
+        self.base_delay = base_delay
+        self.multiplier = multiplier
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.max_attempts = max_attempts
+        self.parking_queue = parking_queue
+
+    def tiers(self):
+        """The TTLs, in milliseconds, of the delay queues."""
+        tiers = []
+        delay = self.base_delay
+        while delay < self.max_delay:
+            tiers.append(int(delay * 1000))
+            delay *= self.multiplier
+        tiers.append(int(self.max_delay * 1000))
+        return tiers
+
+    def delay(self, attempt, requested=None):
+        """Seconds to wait before the given retry attempt, starting at 1."""
+        if requested is not None:
+            return min(requested, self.max_delay)
+        delay = min(self.base_delay * self.multiplier ** (attempt - 1), self.max_delay)
+        return delay * (1 - self.jitter * random.random())
+
+    def tier_for(self, delay_ms):
+        """The TTL of the shortest delay queue that can hold a delay."""
+        for tier in self.tiers():
+            if delay_ms <= tier:
+                return tier
+        return tier
+
+
+class _IOLoopCallbacks(object):
+    """
+    Lets worker threads schedule callbacks to run on the pika IOLoop thread.
+    The IOLoop is woken up through a pipe registered as one of its handlers.
+    """
+    def __init__(self):
+        self._callbacks = deque()
+        self._read_fd, self._write_fd = os.pipe()
+        for fd in (self._read_fd, self._write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        # Guards the pipe against being closed, and its descriptors reused, during add().
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def attach(self, ioloop):
+        """Register with a connection's IOLoop; each new connection has its own."""
+        ioloop.add_handler(self._read_fd, self._on_readable, READ)
+
+    def add(self, callback):
+        """
+        Schedule callback to run on the IOLoop. Safe to call from any thread.
+        Returns False, without scheduling it, once closed.
+        """
+        with self._lock:
+            if self.closed:
+                return False
+            self._callbacks.append(callback)
+            try:
+                os.write(self._write_fd, b'x')
+            except OSError as e:
+                # A full pipe means the IOLoop has already been woken up.
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+        return True
+
+    def _on_readable(self, *unused_args, **unused_kwargs):
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        while self._callbacks:
+            self._callbacks.popleft()()
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            os.close(self._read_fd)
+            os.close(self._write_fd)
+
+
+class _AckBatcher(object):
+    """
+    Coalesces acknowledgements into a single Basic.Ack with multiple=True once
+    max_count are waiting or max_delay seconds have passed since the first.
+
+    Only the contiguous run of settled deliveries, in delivery order, is
+    acknowledged, so a multi-ack never covers a message that is still being
+    processed. Nacks are always sent straight away.
+    """
+    def __init__(self, max_count, max_delay):
+        self.max_count = max_count
+        self.max_delay = max_delay
+        self.reset(None, None)
+
+    def reset(self, channel, connection):
+        """Start afresh on a new channel; delivery tags are per channel."""
+        self._channel = channel
+        self._connection = connection
+        self._unsettled = deque()
+        self._settled = {}
+        self._pending = 0
+        self._timer = None
+
+    @property
+    def batching(self):
+        return self.max_count > 1
+
+    def delivered(self, delivery_tag):
+        if self.batching:
+            self._unsettled.append(delivery_tag)
+
+    def ack(self, delivery_tag):
+        if not self.batching:
+            self._channel.basic_ack(delivery_tag)
+            return
+        self._settled[delivery_tag] = True
+        self._pending += 1
+        if self._pending >= self.max_count:
+            self.flush()
+        else:
+            self._schedule()
+
+    def nack(self, delivery_tag, requeue):
+        self._channel.basic_nack(delivery_tag, requeue=requeue)
+        if self.batching:
+            self._settled[delivery_tag] = False
+            if self._pending:
+                self._schedule()
+
+    def _schedule(self):
+        if self._timer is None and self._connection is not None:
+            self._timer = self._connection.add_timeout(self.max_delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self.flush()
+
+    def flush(self):
+        """Send a multi-ack covering every settled delivery that can be."""
+        if self._timer is not None:
+            self._connection.remove_timeout(self._timer)
+            self._timer = None
+
+        last_acked = None
+        while self._unsettled and self._unsettled[0] in self._settled:
+            delivery_tag = self._unsettled.popleft()
+            if self._settled.pop(delivery_tag):
+                last_acked = delivery_tag
+                self._pending -= 1
+
+        if last_acked is not None and self._channel is not None and self._channel.is_open:
+            self._channel.basic_ack(last_acked, multiple=True)
+        if self._pending:
+            self._schedule()
+
+
 class Consumer(object):
-    def __init__(self, amqp_url, amqp_options=["heartbeat_interval=10"], exchange=None, exchange_type='topic', queue=None, routing_key=None, on_message_callback=None, logging=True):
+    def __init__(self, amqp_url, amqp_options=["heartbeat_interval=10"], exchange=None, exchange_type='topic', queue=None, routing_key=None, on_message_callback=None, logging=True,
+                 prefetch_count=None, prefetch_size=0, ack_batch_size=1, ack_batch_interval=0.1,
+                 concurrency=None, workers=4, on_batch_callback=None, batch_size=100, batch_interval=0.05,
+                 retry_policy=None, codec=None, log_body_bytes=256, log_sample_rate=1.0,
+                 instrument=False, report_metrics=False, stats_interval=10, connection_class=pika.SelectConnection):
         """
         Create a new instance of the consumer class, passing in the AMQP
         URL used to connect to RabbitMQ.
@@ -26,6 +444,30 @@ class Consumer(object):
         queue: queue name
         routing_key: routing from exchange to queue
         on_message_callback: the callback to run when a message hits the queue. takes two arguments. (header_frame, body)
+        prefetch_count: maximum number of unacknowledged messages RabbitMQ will send us. unlimited if None.
+        prefetch_size: maximum total size in bytes of unacknowledged messages. unlimited if 0.
+        ack_batch_size: send one multi-ack per this many messages instead of one ack each.
+            keep it below prefetch_count, or deliveries stall until ack_batch_interval passes.
+        ack_batch_interval: seconds to wait before acking a partial batch.
+        concurrency: None to run on_message_callback on the IOLoop thread, or 'thread' or 'process'
+            to run it on a pool of workers. messages in flight are bounded by prefetch_count, which
+            defaults to twice the number of workers. a process pool needs a picklable callback.
+        workers: number of worker threads or processes.
+        on_batch_callback: use instead of on_message_callback to receive a list of (header_frame, body)
+            tuples. raise RetryException or RejectException to retry or reject the whole batch, or
+            BatchException to settle messages individually. a successful batch is acked at once.
+        batch_size: maximum number of messages passed to on_batch_callback.
+        batch_interval: seconds to wait for a batch to fill up before passing on what has arrived.
+        retry_policy: a RetryPolicy to retry messages with a backoff through delay queues. without one,
+            retried messages are requeued straight away.
+        codec: a Codec to decode bodies by content type before passing them to the callback.
+        log_body_bytes: number of bytes of each message body to log. None to log all of it.
+        log_sample_rate: fraction of received messages to log.
+        instrument: keep counters and timings, available from Consumer.stats(), and poll the queue depth.
+        report_metrics: also forward them to statsd through flutil.metrics. implies instrument.
+        stats_interval: seconds between queue depth polls and metric reports.
+        connection_class: called to connect, with the signature of pika.SelectConnection.
+            pass rmq_testing.FakeBroker.connect to run against an in-process broker.
 
         use Consumer.run() to start and Consumer.stop() to stop
         """
@@ -42,6 +484,43 @@ class Consumer(object):
         self._routing_key = routing_key
         self._on_message_callback = on_message_callback
         self._logging = logging
+        if concurrency not in (None, 'thread', 'process'):
+            raise ValueError("concurrency must be None, 'thread' or 'process'")
+        if concurrency and prefetch_count is None:
+            prefetch_count = workers * 2
+        if on_batch_callback:
+            # A batch is acknowledged with a single multi-ack.
+            ack_batch_size = max(ack_batch_size, batch_size)
+            if prefetch_count is not None:
+                prefetch_count = max(prefetch_count, batch_size * (workers if concurrency else 1))
+        self._prefetch_count = prefetch_count
+        self._prefetch_size = prefetch_size
+        self._acks = _AckBatcher(ack_batch_size, ack_batch_interval)
+        self._concurrency = concurrency
+        self._workers = workers
+        self._pool = None
+        self._ioloop_callbacks = None
+        self._in_flight = 0
+        self._draining = False
+        self._on_batch_callback = on_batch_callback
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+        self._batch = []
+        self._batch_timer = None
+        self._retry_policy = retry_policy
+        self._retry_declarations = []
+        self._codec = codec
+        self._log_body_bytes = log_body_bytes
+        self._log_sample_rate = log_sample_rate
+        self._stats = _ConsumerStats() if instrument or report_metrics else None
+        self._metrics = None
+        if report_metrics:
+            from flutil import metrics
+            self._metrics = metrics
+            self._metrics_prefix = 'rmq.%s' % re.sub(r'\W+', '_', (queue or 'consumer').lower())
+        self._stats_interval = stats_interval
+        self._stats_timer = None
+        self._connection_class = connection_class
 
     def connect(self):
         """
@@ -51,9 +530,9 @@ class Consumer(object):
         """
         if self._logging:
             LOGGER.info('Connecting to %s', self._url)
-        return pika.SelectConnection(pika.URLParameters(self._url),
-                                     self.on_connection_open,
-                                     stop_ioloop_on_close=False)
+        return self._connection_class(pika.URLParameters(self._url),
+                                      self.on_connection_open,
+                                      stop_ioloop_on_close=False)
 
     def on_connection_open(self, unused_connection):
         """This method is called by pika once the connection to RabbitMQ has
@@ -66,6 +545,14 @@ class Consumer(object):
         if self._logging:
             LOGGER.info('Adding connection close callback')
         self._connection.add_on_close_callback(self.on_connection_closed)
+        if self._ioloop_callbacks:
+            self._ioloop_callbacks.attach(self._connection.ioloop)
+        if self._stats is not None:
+            if self._stats.disconnected_at is not None:
+                self._stats.reconnects += 1
+                self._stats.reconnect_seconds += time.time() - self._stats.disconnected_at
+                self._stats.disconnected_at = None
+            self._stats_timer = self._connection.add_timeout(self._stats_interval, self._on_stats_timer)
 
         if self._logging:
             LOGGER.info('Creating a new channel')
@@ -83,11 +570,16 @@ class Consumer(object):
 
         """
         self._channel = None
+        if self._stats_timer is not None:
+            self._connection.remove_timeout(self._stats_timer)
+            self._stats_timer = None
         if self._closing:
             self._connection.ioloop.stop()
         else:
             LOGGER.warning('Connection closed, reopening in 5 seconds: (%s) %s',
                            reply_code, reply_text)
+            if self._stats is not None and self._stats.disconnected_at is None:
+                self._stats.disconnected_at = time.time()
             self._connection.add_timeout(5, self.reconnect)
 
     def reconnect(self):
@@ -118,6 +610,9 @@ class Consumer(object):
         if self._logging:
             LOGGER.info('Channel opened')
         self._channel = channel
+        self._acks.reset(channel, self._connection)
+        self._batch = []
+        self._batch_timer = None
         if self._logging:
             LOGGER.info('Adding channel close callback')
         self._channel.add_on_close_callback(self.on_channel_closed)
@@ -193,6 +688,72 @@ class Consumer(object):
         """
         if self._logging:
             LOGGER.info('Queue bound')
+        if self._retry_policy:
+            self.setup_retry_queues()
+        else:
+            self.on_retry_queues_declareok()
+
+    def retry_queue_name(self, ttl_ms):
+        return '%s.retry.%d' % (self._queue, ttl_ms)
+
+    def parking_queue_name(self):
+        return self._retry_policy.parking_queue or '%s.parked' % self._queue
+
+    def setup_retry_queues(self):
+        """Declare the parking queue and the delay queues of the retry policy,
+        one after the other. Messages expiring from a delay queue are
+        dead-lettered through the default exchange straight back into our
+        queue. When done, on_retry_queues_declareok will be invoked.
+
+        """
+        self._retry_declarations = [(self.parking_queue_name(), None)]
+        for ttl_ms in self._retry_policy.tiers():
+            self._retry_declarations.append((self.retry_queue_name(ttl_ms), {
+                'x-message-ttl': ttl_ms,
+                'x-dead-letter-exchange': '',
+                'x-dead-letter-routing-key': self._queue,
+            }))
+        self._declare_next_retry_queue(None)
+
+    def _declare_next_retry_queue(self, unused_frame):
+        if not self._retry_declarations:
+            self.on_retry_queues_declareok()
+            return
+        queue_name, arguments = self._retry_declarations.pop(0)
+        if self._logging:
+            LOGGER.info('Declaring queue %s', queue_name)
+        self._channel.queue_declare(self._declare_next_retry_queue, queue_name,
+                                    durable=True, arguments=arguments)
+
+    def on_retry_queues_declareok(self):
+        """Invoked once any retry queues have been declared. Set the QOS if
+        need be, and start consuming."""
+        if self._prefetch_count or self._prefetch_size:
+            self.set_qos()
+        else:
+            self.start_consuming()
+
+    def set_qos(self):
+        """Limit the number of unacknowledged messages RabbitMQ will deliver
+        by issuing the Basic.Qos RPC command. When it is complete, the
+        on_basic_qos_ok method will be invoked by pika.
+
+        """
+        if self._logging:
+            LOGGER.info('Setting prefetch count %s, size %s', self._prefetch_count, self._prefetch_size)
+        self._channel.basic_qos(self.on_basic_qos_ok,
+                                prefetch_size=self._prefetch_size,
+                                prefetch_count=self._prefetch_count or 0)
+
+    def on_basic_qos_ok(self, unused_frame):
+        """Invoked by pika when the Basic.Qos method has completed. At this
+        point we will start consuming messages.
+
+        :param pika.frame.Method unused_frame: The Basic.QosOk response frame
+
+        """
+        if self._logging:
+            LOGGER.info('QOS set')
         self.start_consuming()
 
     def start_consuming(self):
@@ -237,29 +798,194 @@ class Consumer(object):
 
     def on_message_wrap(self, unused_channel, basic_deliver, properties, body):
         """Invoked by pika when a message is delivered from RabbitMQ."""
-        if self._logging:
+        if self._logging and (self._log_sample_rate >= 1 or random.random() < self._log_sample_rate) \
+                and LOGGER.isEnabledFor(logging.INFO):
             LOGGER.info('Received message # %s from %s: %s',
-                        basic_deliver.delivery_tag, properties.app_id, body)
-        try:
-            self._on_message_callback(properties, body)
-            self.acknowledge_message(basic_deliver.delivery_tag)
-        except RetryException:
-            LOGGER.warning('Caught a RetryException.  Requeueing: %s', basic_deliver.delivery_tag)
-            self._channel.basic_nack(basic_deliver.delivery_tag, requeue=True)
-        except RejectException:
-            LOGGER.warning('Caught a RejectException. Rejecting: %s', basic_deliver.delivery_tag)
-            self._channel.basic_nack(basic_deliver.delivery_tag, requeue=False)
+                        basic_deliver.delivery_tag, properties.app_id, _LazyBody(body, self._log_body_bytes))
+        if self._stats is not None:
+            self._stats.received += 1
+        self._acks.delivered(basic_deliver.delivery_tag)
+        delivery = (basic_deliver.delivery_tag, properties, body)
+        if self._on_batch_callback:
+            self._batch.append(delivery)
+            if len(self._batch) >= self._batch_size:
+                self.flush_batch()
+            elif self._batch_timer is None:
+                self._batch_timer = self._connection.add_timeout(self._batch_interval, self._on_batch_timer)
+        else:
+            self.dispatch([delivery], self._on_message_callback, batch=False)
+
+    def _on_batch_timer(self):
+        self._batch_timer = None
+        self.flush_batch()
+
+    def flush_batch(self):
+        """Pass the messages collected so far to on_batch_callback."""
+        if self._batch_timer is not None:
+            self._connection.remove_timeout(self._batch_timer)
+            self._batch_timer = None
+        if self._batch:
+            deliveries, self._batch = self._batch, []
+            self.dispatch(deliveries, self._on_batch_callback, batch=True)
+
+    def dispatch(self, deliveries, callback, batch):
+        """Run a callback for a list of (delivery_tag, properties, body)
+        deliveries, either right away or on the worker pool."""
+        messages = [(properties, body) for _, properties, body in deliveries]
+        decoders = None
+        if self._codec is not None:
+            decoders = [self._codec.decoder_for(properties.content_type) for properties, _ in messages]
+        started = time.time() if self._stats is not None else None
+        if self._pool is None:
+            outcomes = _invoke(callback, messages, batch, decoders)
+            if started is not None:
+                self._stats.latency_ms.record((time.time() - started) * 1000)
+            self.settle_messages(deliveries, outcomes)
+        else:
+            self._in_flight += len(deliveries)
+            self._pool.apply_async(_run_pooled_callback, (callback, messages, batch, decoders),
+                                   callback=partial(self._on_worker_done, self._channel, deliveries, started))
+
+    def _on_worker_done(self, channel, deliveries, started, result):
+        """Invoked on a pool thread when a worker finishes with some messages;
+        hands the result over to the IOLoop thread."""
+        self._ioloop_callbacks.add(partial(self.on_messages_done, channel, deliveries, result, started))
+
+    def on_messages_done(self, channel, deliveries, result, started=None):
+        """Invoked on the IOLoop thread once a worker has finished with some
+        messages. Results for deliveries on a channel that has since been
+        closed are dropped, as RabbitMQ will redeliver those messages.
+
+        """
+        self._in_flight -= len(deliveries)
+        if started is not None:
+            # Includes the time spent waiting for a free worker.
+            self._stats.latency_ms.record((time.time() - started) * 1000)
+        outcomes, error = result
+        if channel is self._channel:
+            if error:
+                LOGGER.error('Error handling messages %s, requeueing: %s',
+                             ', '.join(str(delivery[0]) for delivery in deliveries), error)
+            self.settle_messages(deliveries, outcomes)
+        if self._draining and not self._in_flight:
+            self._draining = False
+            self._acks.flush()
+            self.close_channel()
+
+    def settle_messages(self, deliveries, outcomes):
+        """Settle each delivery according to its outcome. Acknowledgements for
+        a batch are sent together as a single multi-ack."""
+        for delivery, outcome in zip(deliveries, outcomes):
+            self.settle_message(delivery, outcome)
+        if self._on_batch_callback:
+            self._acks.flush()
+
+    def settle_message(self, delivery, outcome):
+        """Acknowledge, retry or reject a (delivery_tag, properties, body)
+        delivery according to the (kind, retry delay) outcome of its callback."""
+        delivery_tag = delivery[0]
+        kind, delay = outcome
+        if self._stats is not None:
+            self._stats.outcomes[kind] += 1
+        if kind == ACK:
+            self.acknowledge_message(delivery_tag)
+        elif kind in (RETRY, ERROR):
+            if kind == RETRY:
+                LOGGER.warning('Caught a RetryException.  Requeueing: %s', delivery_tag)
+            if self._retry_policy:
+                self.retry_later(delivery, delay)
+            else:
+                self._acks.nack(delivery_tag, requeue=True)
+        elif kind == REJECT:
+            LOGGER.warning('Caught a RejectException. Rejecting: %s', delivery_tag)
+            self._acks.nack(delivery_tag, requeue=False)
+
+    def retry_later(self, delivery, delay=None):
+        """Republish a message to the delay queue matching its next retry
+        delay, or to the parking queue once it has run out of attempts, then
+        acknowledge the original delivery."""
+        delivery_tag, properties, body = delivery
+        headers = dict(properties.headers or {})
+        attempt = headers.get(RETRY_COUNT_HEADER, 0) + 1
+        headers[RETRY_COUNT_HEADER] = attempt
+        properties = copy(properties)
+        properties.headers = headers
+
+        if attempt > self._retry_policy.max_attempts:
+            queue_name = self.parking_queue_name()
+            LOGGER.warning('Message %s failed %d times, parking it in %s', delivery_tag, attempt, queue_name)
+            properties.expiration = None
+        else:
+            delay_ms = max(1, int(self._retry_policy.delay(attempt, delay) * 1000))
+            queue_name = self.retry_queue_name(self._retry_policy.tier_for(delay_ms))
+            properties.expiration = str(delay_ms)
+        self._channel.basic_publish('', queue_name, body, properties)
+        self.acknowledge_message(delivery_tag)
+
+    def _on_stats_timer(self):
+        self._stats_timer = self._connection.add_timeout(self._stats_interval, self._on_stats_timer)
+        if self._channel is not None and self._consumer_tag is not None and not self._closing:
+            self._channel.queue_declare(self.on_queue_depth, queue=self._queue, passive=True)
+        if self._metrics is not None:
+            self.stats()
+
+    def on_queue_depth(self, method_frame):
+        """Invoked by pika with the result of the passive Queue.Declare that
+        polls the number of messages waiting in the queue."""
+        self._stats.queue_depth = method_frame.method.message_count
+        self._stats.queue_consumers = method_frame.method.consumer_count
+
+    def stats(self):
+        """
+        Return a snapshot of the consumer: messages received and their rate
+        since the previous snapshot, outcome counters, messages in flight,
+        latency percentiles in milliseconds from receipt to settlement, time
+        spent reconnecting and the last polled queue depth. Also forwards them
+        to statsd when report_metrics is set.
+        """
+        if self._stats is None:
+            raise RuntimeError('Consumer was created without instrument=True')
+        stats = self._stats
+        snapshot = {
+            'received': stats.received,
+            'messages_per_second': stats.rate(),
+            'acked': stats.outcomes[ACK],
+            'retried': stats.outcomes[RETRY],
+            'rejected': stats.outcomes[REJECT],
+            'errors': stats.outcomes[ERROR],
+            'in_flight': self._in_flight + len(self._batch),
+            'latency_ms': stats.latency_ms.snapshot(),
+            'reconnects': stats.reconnects,
+            'reconnect_seconds': stats.reconnect_seconds + (
+                time.time() - stats.disconnected_at if stats.disconnected_at is not None else 0),
+            'queue_depth': stats.queue_depth,
+            'queue_consumers': stats.queue_consumers,
+        }
+        if self._metrics is not None:
+            prefix = self._metrics_prefix
+            counters = dict((key, snapshot[key]) for key in ('received', 'acked', 'retried', 'rejected', 'errors', 'reconnects'))
+            for key, delta in stats.deltas(counters).items():
+                if delta:
+                    self._metrics.incr('%s.%s' % (prefix, key), delta)
+            for key in ('messages_per_second', 'in_flight', 'queue_depth'):
+                if snapshot[key] is not None:
+                    self._metrics.gauge('%s.%s' % (prefix, key), snapshot[key])
+            for key in ('p50', 'p99'):
+                if snapshot['latency_ms'][key] is not None:
+                    self._metrics.gauge('%s.latency_ms.%s' % (prefix, key), snapshot['latency_ms'][key])
+        return snapshot
 
     def acknowledge_message(self, delivery_tag):
         """Acknowledge the message delivery from RabbitMQ by sending a
-        Basic.Ack RPC method for the delivery tag.
+        Basic.Ack RPC method for the delivery tag, or by adding it to the
+        current batch of acknowledgements when ack_batch_size > 1.
 
         :param int delivery_tag: The delivery tag from the Basic.Deliver frame
 
         """
         if self._logging:
             LOGGER.info('Acknowledging message %s', delivery_tag)
-        self._channel.basic_ack(delivery_tag)
+        self._acks.ack(delivery_tag)
 
     def stop_consuming(self):
         """Tell RabbitMQ that you would like to stop consuming by sending the
@@ -281,7 +1007,13 @@ class Consumer(object):
 
         """
         LOGGER.info('RabbitMQ acknowledged the cancellation of the consumer')
-        self.close_channel()
+        if self._in_flight:
+            # on_messages_done closes the channel once the last one finishes.
+            LOGGER.info('Waiting for %d messages in flight', self._in_flight)
+            self._draining = True
+        else:
+            self._acks.flush()
+            self.close_channel()
 
     def close_channel(self):
         """Call to close the channel with RabbitMQ cleanly by issuing the
@@ -297,6 +1029,13 @@ class Consumer(object):
         starting the IOLoop to block and allow the SelectConnection to operate.
 
         """
+        if self._concurrency and self._pool is None:
+            # Start workers before connecting, so forked processes don't share the socket.
+            if self._concurrency == 'process':
+                self._pool = multiprocessing.Pool(self._workers)
+            else:
+                self._pool = ThreadPool(self._workers)
+            self._ioloop_callbacks = _IOLoopCallbacks()
         self._connection = self.connect()
         self._connection.ioloop.start()
 
@@ -310,12 +1049,23 @@ class Consumer(object):
         communicate with RabbitMQ. All of the commands issued prior to starting
         the IOLoop will be buffered but not processed.
 
+        When callbacks run on a worker pool, messages already in flight are
+        finished and settled before the channel is closed.
+
         """
         if self._logging:
             LOGGER.info('Stopping')
         self._closing = True
+        self.flush_batch()
+        self._acks.flush()
         self.stop_consuming()
         self._connection.ioloop.start()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._ioloop_callbacks.close()
+            self._ioloop_callbacks = None
         if self._logging:
             LOGGER.info('Stopped')
 
@@ -324,3 +1074,322 @@ class Consumer(object):
         if self._logging:
             LOGGER.info('Closing connection')
         self._connection.close()
+
+
+class Publisher(object):
+    def __init__(self, amqp_url, amqp_options=["heartbeat_interval=10"], exchange=None, exchange_type='topic', routing_key=None, logging=True,
+                 confirm_window=1000, max_republish=3, connection_class=pika.SelectConnection):
+        """
+        Create a new instance of the publisher class, passing in the AMQP
+        URL used to connect to RabbitMQ.
+        This automatically adds the heartbeat parameter to allow keepalives.
+
+        The publisher keeps one connection and channel open on a background
+        thread, and publishes with publisher confirms enabled without waiting
+        for each confirm. Messages that have not been confirmed when the
+        connection drops are published again once it has been reopened, and
+        nacked messages straight away.
+
+        exchange: exchange name. uses the default exchange if None.
+        exchange_type: defaults to topic. don't need to touch this usually.
+        routing_key: default routing key for published messages
+        confirm_window: maximum number of unconfirmed messages. publish() blocks while it is full.
+            use 1 to wait for a confirm after every message.
+        max_republish: number of times a message is published again, after a nack or a dropped
+            connection, before it is dropped and logged as an error.
+        connection_class: called to connect, with the signature of pika.SelectConnection.
+
+        use Publisher.start() to start and Publisher.stop() to stop
+        """
+        self._connection = None
+        self._channel = None
+        self._closing = False
+        self._url = amqp_url
+        if amqp_options:
+            self._url += '?{}'.format('&'.join(amqp_options))
+        self._exchange = exchange
+        self._exchange_type = exchange_type
+        self._routing_key = routing_key
+        self._logging = logging
+        self._confirm_window = confirm_window
+        self._max_republish = max_republish
+        self._connection_class = connection_class
+
+        self._thread = None
+        self._ioloop_callbacks = _IOLoopCallbacks()
+        self._window = threading.Condition()
+        self._outstanding = 0
+
+        # Only touched on the IOLoop thread.
+        self._ready = False
+        self._pending = deque()
+        self._unconfirmed = {}
+        self._message_number = 0
+
+        self.published = 0
+        self.confirmed = 0
+        self.nacked = 0
+        self.replayed = 0
+        self.dropped = 0
+
+    def connect(self):
+        """
+        This method connects to RabbitMQ, returning the connection handle.
+        When the connection is established, the on_connection_open method
+        will be invoked by pika.
+        """
+        if self._logging:
+            LOGGER.info('Connecting to %s', self._url)
+        return self._connection_class(pika.URLParameters(self._url),
+                                      self.on_connection_open,
+                                      stop_ioloop_on_close=False)
+
+    def on_connection_open(self, unused_connection):
+        """This method is called by pika once the connection to RabbitMQ has
+        been established.
+
+        :type unused_connection: pika.SelectConnection
+
+        """
+        self._connection.add_on_close_callback(self.on_connection_closed)
+        self._ioloop_callbacks.attach(self._connection.ioloop)
+        if self._logging:
+            LOGGER.info('Creating a new channel')
+        self._connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_connection_closed(self, connection, reply_code, reply_text):
+        """
+        This method is invoked by pika when the connection to RabbitMQ is
+        closed. Unless we are stopping, reconnect in 5 seconds.
+
+        :param pika.connection.Connection connection: The closed connection obj
+        :param int reply_code: The server provided reply_code if given
+        :param str reply_text: The server provided reply_text if given
+
+        """
+        self._channel = None
+        self._ready = False
+        if self._closing:
+            self._connection.ioloop.stop()
+        else:
+            LOGGER.warning('Connection closed, reopening in 5 seconds: (%s) %s',
+                           reply_code, reply_text)
+            self._connection.add_timeout(5, self.reconnect)
+
+    def reconnect(self):
+        """Will be invoked by the IOLoop timer if the connection is
+        closed. See the on_connection_closed method.
+
+        """
+        self._connection.ioloop.stop()
+        if not self._closing:
+            self._connection = self.connect()
+            self._connection.ioloop.start()
+
+    def on_channel_open(self, channel):
+        """This method is invoked by pika when the channel has been opened.
+        Declares the exchange, if any, and then enables publisher confirms.
+
+        :param pika.channel.Channel channel: The channel object
+
+        """
+        if self._logging:
+            LOGGER.info('Channel opened')
+        self._channel = channel
+        self._channel.add_on_close_callback(self.on_channel_closed)
+        if self._exchange:
+            self._channel.exchange_declare(self.on_exchange_declareok,
+                                           self._exchange,
+                                           self._exchange_type,
+                                           durable=True)
+        else:
+            self.enable_delivery_confirmations()
+
+    def on_channel_closed(self, channel, reply_code, reply_text):
+        """Invoked by pika when RabbitMQ unexpectedly closes the channel.
+        Closing the connection triggers a reconnect.
+
+        :param pika.channel.Channel: The closed channel
+        :param int reply_code: The numeric reason the channel was closed
+        :param str reply_text: The text reason the channel was closed
+
+        """
+        LOGGER.warning('Channel %i was closed: (%s) %s',
+                       channel, reply_code, reply_text)
+        self._channel = None
+        self._ready = False
+        if not self._connection.is_closing and not self._connection.is_closed:
+            self._connection.close()
+
+    def on_exchange_declareok(self, unused_frame):
+        """Invoked by pika when RabbitMQ has finished the Exchange.Declare RPC
+        command.
+
+        :param pika.Frame.Method unused_frame: Exchange.DeclareOk response frame
+
+        """
+        if self._logging:
+            LOGGER.info('Exchange declared')
+        self.enable_delivery_confirmations()
+
+    def enable_delivery_confirmations(self):
+        """Send the Confirm.Select RPC method to RabbitMQ to enable delivery
+        confirmations on the channel, then publish everything that is waiting:
+        first any messages left unconfirmed on a previous connection, in their
+        original order, then new ones.
+
+        """
+        if self._logging:
+            LOGGER.info('Issuing Confirm.Select RPC command')
+        self._channel.confirm_delivery(self.on_delivery_confirmation)
+        self._message_number = 0
+        self._ready = True
+
+        if self._unconfirmed:
+            replay = self._republishable([self._unconfirmed[number] for number in sorted(self._unconfirmed)])
+            self._unconfirmed = {}
+            self.replayed += len(replay)
+            LOGGER.info('Republishing %d unconfirmed messages', len(replay))
+            self._pending.extendleft(reversed(replay))
+        while self._pending and self._ready:
+            self._basic_publish(self._pending.popleft())
+
+    def on_delivery_confirmation(self, method_frame):
+        """Invoked by pika when RabbitMQ responds to a Basic.Publish RPC
+        command with a Basic.Ack or Basic.Nack, which may cover every message
+        up to the delivery tag. Nacked messages are published again.
+
+        :param pika.frame.Method method_frame: Basic.Ack or Basic.Nack frame
+
+        """
+        method = method_frame.method
+        acked = method.NAME == 'Basic.Ack'
+        if method.multiple:
+            numbers = [number for number in self._unconfirmed if number <= method.delivery_tag]
+        else:
+            numbers = [method.delivery_tag] if method.delivery_tag in self._unconfirmed else []
+
+        messages = [self._unconfirmed.pop(number) for number in sorted(numbers)]
+        if acked:
+            self.confirmed += len(messages)
+            self._release(len(messages))
+        else:
+            self.nacked += len(messages)
+            LOGGER.warning('RabbitMQ nacked %d messages, republishing', len(messages))
+            for message in self._republishable(messages):
+                self._basic_publish(message)
+
+    def _republishable(self, messages):
+        """
+        The messages to publish again, counting the attempt; those published
+        max_republish times already are dropped instead.
+        """
+        republish = []
+        for exchange, routing_key, body, properties, attempts in messages:
+            if attempts < self._max_republish:
+                republish.append((exchange, routing_key, body, properties, attempts + 1))
+        dropped = len(messages) - len(republish)
+        if dropped:
+            self.dropped += dropped
+            LOGGER.error('Dropping %d messages published %d times without being confirmed',
+                         dropped, self._max_republish + 1)
+            self._release(dropped)
+        return republish
+
+    def _release(self, count):
+        with self._window:
+            self._outstanding -= count
+            self._window.notify_all()
+
+    def _basic_publish(self, message):
+        # Must be called on the IOLoop thread.
+        if not self._ready:
+            self._pending.append(message)
+            return
+        exchange, routing_key, body, properties, _ = message
+        self._channel.basic_publish(exchange, routing_key, body, properties)
+        self._message_number += 1
+        self._unconfirmed[self._message_number] = message
+        self.published += 1
+
+    def publish(self, body, routing_key=None, properties=None, timeout=None):
+        """
+        Publish a message without waiting for RabbitMQ to confirm it. Safe to
+        call from any thread. Blocks while confirm_window messages are waiting
+        to be confirmed, raising PublishTimeoutException after timeout seconds.
+        Raises PublisherNotRunningException once the publisher has stopped.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._window:
+            while self._outstanding >= self._confirm_window:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PublishTimeoutException('%d messages waiting to be confirmed' % self._outstanding)
+                self._window.wait(remaining)
+            self._outstanding += 1
+
+        message = (self._exchange or '', routing_key or self._routing_key, body, properties, 0)
+        if not self._ioloop_callbacks.add(partial(self._basic_publish, message)):
+            self._release(1)
+            raise PublisherNotRunningException('Publisher is not running')
+
+    def wait_for_confirms(self, timeout=None):
+        """
+        Block until every published message has been confirmed. Returns False
+        if that didn't happen within timeout seconds.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._window:
+            while self._outstanding:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self._window.wait(remaining)
+        return True
+
+    def start(self):
+        """Connect to RabbitMQ and run the IOLoop on a background thread."""
+        if self._ioloop_callbacks.closed:
+            self._ioloop_callbacks = _IOLoopCallbacks()
+        self._thread = threading.Thread(target=self.run, name='flutil-rmq-publisher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run(self):
+        """Connect to RabbitMQ and run the IOLoop on the current thread."""
+        if self._ioloop_callbacks.closed:
+            self._ioloop_callbacks = _IOLoopCallbacks()
+        try:
+            self._connection = self.connect()
+            self._connection.ioloop.start()
+        finally:
+            # Closed rather than cleared, so that publish() and stop() from other threads can tell.
+            self._ioloop_callbacks.close()
+
+    def stop(self, timeout=10):
+        """Wait up to timeout seconds for outstanding confirms, then close the
+        connection and wait for the IOLoop thread to finish."""
+        if self._logging:
+            LOGGER.info('Stopping')
+        if not self.wait_for_confirms(timeout):
+            LOGGER.warning('Stopping with %d unconfirmed messages', self._outstanding)
+        self._closing = True
+        if not self._ioloop_callbacks.add(self.close_connection):
+            LOGGER.info('Publisher was not running')
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._logging:
+            LOGGER.info('Stopped')
+
+    def close_connection(self):
+        """This method closes the connection to RabbitMQ."""
+        if self._logging:
+            LOGGER.info('Closing connection')
+        if self._connection.is_closed:
+            self._connection.ioloop.stop()
+        elif not self._connection.is_closing:
+            self._connection.close()
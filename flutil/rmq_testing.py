@@ -0,0 +1,644 @@
+"""
+In-process stand-in for RabbitMQ, and benchmarks for rmq.Consumer and
+rmq.Publisher built on it.
+
+FakeBroker.connect can be passed as the connection_class of a Consumer or
+Publisher in place of pika.SelectConnection. It drives the same callbacks, in
+the same order, from a single-threaded IOLoop, so no RabbitMQ is needed:
+
+    broker = FakeBroker()
+    broker.declare_queue('jobs')
+    broker.publish('', 'jobs', '{"id": 1}')
+    consumer = Consumer('amqp://fake', queue='jobs', exchange='events',
+                        on_message_callback=handle, connection_class=broker.connect)
+
+Run the benchmarks with `python -m flutil.rmq_testing --help`.
+"""
+import argparse
+import heapq
+import itertools
+import json
+import random
+import select
+import time
+from collections import OrderedDict, deque
+from copy import copy
+from functools import partial
+
+import pika
+from pika import exceptions, frame, spec
+from pika.adapters.select_connection import READ
+
+from flutil.metrics import Histogram
+from flutil.rmq import Consumer, Publisher, RejectException, RetryException
+
+
+class FakeIOLoop(object):
+    """
+    Minimal stand-in for pika's IOLoop: runs callbacks in the order they were
+    scheduled, fires timeouts and watches file descriptors for reading.
+    Timeout delays are multiplied by time_scale, so that a benchmark doesn't
+    have to sit through reconnect delays.
+    """
+    def __init__(self, time_scale=1.0):
+        self.time_scale = time_scale
+        self._callbacks = deque()
+        self._timeouts = []
+        self._cancelled = set()
+        self._handlers = {}
+        self._ids = itertools.count(1)
+        self._stopping = False
+
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def add_timeout(self, deadline, callback):
+        timeout_id = next(self._ids)
+        heapq.heappush(self._timeouts, (time.time() + deadline * self.time_scale, timeout_id, callback))
+        return timeout_id
+
+    def remove_timeout(self, timeout_id):
+        self._cancelled.add(timeout_id)
+
+    def add_handler(self, fd, handler, events):
+        self._handlers[fd] = handler
+
+    def remove_handler(self, fd):
+        self._handlers.pop(fd, None)
+
+    def start(self):
+        self._stopping = False
+        while not self._stopping:
+            self.poll()
+
+    def stop(self):
+        self._stopping = True
+
+    def poll(self):
+        for _ in range(len(self._callbacks)):
+            self._callbacks.popleft()()
+            if self._stopping:
+                return
+
+        now = time.time()
+        while self._timeouts and self._timeouts[0][0] <= now:
+            _, timeout_id, callback = heapq.heappop(self._timeouts)
+            if timeout_id in self._cancelled:
+                self._cancelled.discard(timeout_id)
+                continue
+            callback()
+            if self._stopping:
+                return
+
+        if self._callbacks:
+            wait = 0
+        elif self._timeouts:
+            wait = max(0, self._timeouts[0][0] - time.time())
+        elif self._handlers:
+            wait = 1
+        else:
+            raise RuntimeError('IOLoop has nothing left to run')
+        if self._handlers:
+            readable, _, _ = select.select(list(self._handlers), [], [], wait)
+            for fd in readable:
+                handler = self._handlers.get(fd)
+                if handler is not None:
+                    handler(fd, READ)
+        elif wait:
+            time.sleep(wait)
+
+
+class _Message(object):
+    __slots__ = ('exchange', 'routing_key', 'body', 'properties', 'redelivered', 'timeout')
+
+    def __init__(self, exchange, routing_key, body, properties):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.body = body
+        self.properties = properties or pika.BasicProperties()
+        self.redelivered = False
+        self.timeout = None
+
+
+class _Queue(object):
+    def __init__(self, name, arguments):
+        self.name = name
+        self.arguments = arguments or {}
+        self.messages = deque()
+        self.consumers = []
+
+
+def _topic_matches(pattern, words):
+    if not pattern:
+        return not words
+    if pattern[0] == '#':
+        return any(_topic_matches(pattern[1:], words[i:]) for i in range(len(words) + 1))
+    if not words or pattern[0] not in ('*', words[0]):
+        return False
+    return _topic_matches(pattern[1:], words[1:])
+
+
+class FakeBroker(object):
+    """
+    Exchanges, queues and bindings shared by every connection made through
+    FakeBroker.connect. Supports direct, fanout and topic exchanges, the
+    default exchange, prefetch limits, requeueing of unacknowledged messages
+    when a channel closes, and dead-lettering of expired messages, which is
+    what rmq.RetryPolicy's delay queues rely on.
+
+    - time_scale scales every timeout of the connections' IOLoops
+    - disconnect_every forces the connection closed, as RabbitMQ does when it
+      restarts, after that many deliveries
+    - confirm_delay is the number of seconds before each publish is confirmed,
+      on channels in confirm mode, standing in for the round trip to RabbitMQ
+
+    """
+    def __init__(self, time_scale=1.0, disconnect_every=None, confirm_delay=0):
+        self.time_scale = time_scale
+        self.disconnect_every = disconnect_every
+        self.confirm_delay = confirm_delay
+        self.exchanges = {'': 'direct'}
+        self.queues = {}
+        self.bindings = {}
+        self.connections = []
+        self._consumer_tags = itertools.count(1)
+        self.published = 0
+        self.delivered = 0
+        self.acked = 0
+        self.requeued = 0
+        self.dropped = 0
+        self.dead_lettered = 0
+        self.disconnects = 0
+        self.ack_latency_ms = Histogram()
+
+    def connect(self, parameters=None, on_open_callback=None, on_open_error_callback=None,
+                on_close_callback=None, stop_ioloop_on_close=True, custom_ioloop=None):
+        """Open a connection, with the same signature as pika.SelectConnection."""
+        connection = FakeConnection(self, on_open_callback, on_close_callback, stop_ioloop_on_close,
+                                    custom_ioloop or FakeIOLoop(self.time_scale))
+        self.connections.append(connection)
+        return connection
+
+    def declare_exchange(self, exchange, exchange_type='direct'):
+        self.exchanges.setdefault(exchange, exchange_type)
+
+    def declare_queue(self, queue, arguments=None):
+        if queue not in self.queues:
+            self.queues[queue] = _Queue(queue, arguments)
+        return self.queues[queue]
+
+    def bind(self, queue, exchange, routing_key):
+        self.bindings.setdefault(exchange, set()).add((queue, routing_key))
+
+    def _route(self, exchange, routing_key):
+        if exchange == '':
+            return [routing_key] if routing_key in self.queues else []
+        exchange_type = self.exchanges.get(exchange)
+        bindings = self.bindings.get(exchange, ())
+        if exchange_type == 'fanout':
+            return [queue for queue, _ in bindings]
+        if exchange_type == 'topic':
+            words = routing_key.split('.') if routing_key else []
+            return [queue for queue, key in bindings if _topic_matches(key.split('.') if key else [], words)]
+        return [queue for queue, key in bindings if key == routing_key]
+
+    def publish(self, exchange, routing_key, body, properties=None, ioloop=None):
+        """Route a message to its queues. Returns the number of queues it went to."""
+        self.published += 1
+        queues = self._route(exchange, routing_key)
+        for name in queues:
+            self._enqueue(self.queues[name], _Message(exchange, routing_key, body, properties), ioloop)
+        return len(queues)
+
+    def _enqueue(self, queue, message, ioloop, front=False):
+        ttls = [queue.arguments.get('x-message-ttl'), message.properties.expiration]
+        ttls = [int(ttl) for ttl in ttls if ttl is not None]
+        if ttls and ioloop is not None:
+            message.timeout = (ioloop, ioloop.add_timeout(min(ttls) / 1000.0, partial(self._expire, queue, message)))
+        if front:
+            queue.messages.appendleft(message)
+        else:
+            queue.messages.append(message)
+        self._wake(queue)
+
+    def _expire(self, queue, message):
+        try:
+            queue.messages.remove(message)
+        except ValueError:
+            return
+        message.timeout = None
+        self.dead_letter(queue, message)
+
+    def dead_letter(self, queue, message):
+        exchange = queue.arguments.get('x-dead-letter-exchange')
+        if exchange is None:
+            self.dropped += 1
+            return
+        self.dead_lettered += 1
+        routing_key = queue.arguments.get('x-dead-letter-routing-key', message.routing_key)
+        properties = copy(message.properties)
+        properties.expiration = None
+        for name in self._route(exchange, routing_key):
+            self._enqueue(self.queues[name], _Message(exchange, routing_key, message.body, properties), None)
+
+    def requeue(self, queue, message):
+        self.requeued += 1
+        message.redelivered = True
+        self._enqueue(queue, message, None, front=True)
+
+    def _take(self, queue):
+        message = queue.messages.popleft()
+        if message.timeout is not None:
+            ioloop, timeout_id = message.timeout
+            ioloop.remove_timeout(timeout_id)
+            message.timeout = None
+        return message
+
+    def _wake(self, queue):
+        for channel, _ in queue.consumers:
+            channel._schedule_deliveries()
+
+    def on_settled(self, connection):
+        """Called whenever messages are acknowledged or rejected; for subclasses."""
+
+    def _delivered(self, connection):
+        self.delivered += 1
+        if self.disconnect_every and self.delivered % self.disconnect_every == 0:
+            self.disconnects += 1
+            connection.ioloop.add_callback(partial(connection.close, 320, 'CONNECTION_FORCED - fake broker restart'))
+
+
+class FakeConnection(object):
+    """Stand-in for pika.SelectConnection, made by FakeBroker.connect."""
+    def __init__(self, broker, on_open_callback, on_close_callback, stop_ioloop_on_close, ioloop):
+        self.broker = broker
+        self.ioloop = ioloop
+        self.stop_ioloop_on_close = stop_ioloop_on_close
+        self.is_open = False
+        self.is_closing = False
+        self.is_closed = False
+        self._channels = {}
+        self._channel_numbers = itertools.count(1)
+        self._on_close_callbacks = [on_close_callback] if on_close_callback else []
+        self.ioloop.add_callback(partial(self._open, on_open_callback))
+
+    def _open(self, on_open_callback):
+        self.is_open = True
+        if on_open_callback:
+            on_open_callback(self)
+
+    def add_on_close_callback(self, callback):
+        self._on_close_callbacks.append(callback)
+
+    def add_timeout(self, deadline, callback):
+        return self.ioloop.add_timeout(deadline, callback)
+
+    def remove_timeout(self, timeout_id):
+        self.ioloop.remove_timeout(timeout_id)
+
+    def channel(self, on_open_callback, channel_number=None):
+        channel = FakeChannel(self, channel_number or next(self._channel_numbers))
+        self._channels[channel.channel_number] = channel
+        self.ioloop.add_callback(partial(on_open_callback, channel))
+        return channel
+
+    def close(self, reply_code=200, reply_text='Normal shutdown'):
+        if self.is_closing or self.is_closed:
+            return
+        self.is_closing = True
+        self.ioloop.add_callback(partial(self._closed, reply_code, reply_text))
+
+    def _closed(self, reply_code, reply_text):
+        # Like pika, close every channel and then the connection in one go.
+        self.is_open = self.is_closing = False
+        self.is_closed = True
+        for channel in list(self._channels.values()):
+            channel._close(reply_code, reply_text, notify_now=True)
+        for callback in self._on_close_callbacks:
+            callback(self, reply_code, reply_text)
+        if self.stop_ioloop_on_close:
+            self.ioloop.stop()
+
+
+class FakeChannel(object):
+    """Stand-in for pika.channel.Channel, made by FakeConnection.channel."""
+    def __init__(self, connection, channel_number):
+        self.connection = connection
+        self.broker = connection.broker
+        self.channel_number = channel_number
+        self.is_open = True
+        self._on_close_callbacks = []
+        self._on_cancel_callbacks = []
+        self._consumers = {}
+        self._unacked = OrderedDict()
+        self._delivery_tags = itertools.count(1)
+        self._prefetch_count = 0
+        self._deliveries_scheduled = False
+        self._on_confirm = None
+        self._publish_tags = itertools.count(1)
+
+    def __int__(self):
+        return self.channel_number
+
+    def _reply(self, callback, method):
+        if callback is not None:
+            self.connection.ioloop.add_callback(partial(callback, frame.Method(self.channel_number, method)))
+
+    def add_on_close_callback(self, callback):
+        self._on_close_callbacks.append(callback)
+
+    def add_on_cancel_callback(self, callback):
+        self._on_cancel_callbacks.append(callback)
+
+    def exchange_declare(self, callback=None, exchange=None, exchange_type='direct', passive=False, durable=False,
+                         auto_delete=False, internal=False, nowait=False, arguments=None, type=None):
+        self.broker.declare_exchange(exchange, type or exchange_type)
+        self._reply(callback, spec.Exchange.DeclareOk())
+
+    def queue_declare(self, callback, queue='', passive=False, durable=False, exclusive=False,
+                      auto_delete=False, nowait=False, arguments=None):
+        if passive and queue not in self.broker.queues:
+            self._close(404, "NOT_FOUND - no queue '%s'" % queue)
+            return
+        declared = self.broker.declare_queue(queue, arguments)
+        self._reply(callback, spec.Queue.DeclareOk(queue, len(declared.messages), len(declared.consumers)))
+
+    def queue_bind(self, callback, queue, exchange, routing_key=None, nowait=False, arguments=None):
+        self.broker.bind(queue, exchange, routing_key)
+        self._reply(callback, spec.Queue.BindOk())
+
+    def basic_qos(self, callback=None, prefetch_size=0, prefetch_count=0, all_channels=False):
+        self._prefetch_count = prefetch_count
+        self._reply(callback, spec.Basic.QosOk())
+        self._schedule_deliveries()
+
+    def basic_consume(self, consumer_callback, queue='', no_ack=False, exclusive=False, consumer_tag=None, arguments=None):
+        consumer_tag = consumer_tag or 'ctag%d.fake' % next(self.broker._consumer_tags)
+        self._consumers[consumer_tag] = (queue, consumer_callback)
+        self.broker.queues[queue].consumers.append((self, consumer_tag))
+        self._schedule_deliveries()
+        return consumer_tag
+
+    def basic_cancel(self, callback=None, consumer_tag='', nowait=False):
+        self._cancel(consumer_tag)
+        self._reply(callback, spec.Basic.CancelOk(consumer_tag))
+
+    def _cancel(self, consumer_tag):
+        queue_name, _ = self._consumers.pop(consumer_tag, (None, None))
+        if queue_name is not None:
+            self.broker.queues[queue_name].consumers.remove((self, consumer_tag))
+
+    def _schedule_deliveries(self):
+        if not self._deliveries_scheduled and self.is_open:
+            self._deliveries_scheduled = True
+            self.connection.ioloop.add_callback(self._deliver)
+
+    def _deliver(self):
+        """Deliver a message to each of our consumers in turn, up to the
+        prefetch limit, then let the IOLoop run anything else that is due
+        before the next round."""
+        self._deliveries_scheduled = False
+        for consumer_tag, (queue_name, callback) in list(self._consumers.items()):
+            if not self.is_open or (self._prefetch_count and len(self._unacked) >= self._prefetch_count):
+                return
+            queue = self.broker.queues[queue_name]
+            if not queue.messages:
+                continue
+            message = self.broker._take(queue)
+            delivery_tag = next(self._delivery_tags)
+            self._unacked[delivery_tag] = (queue, message, time.time())
+            deliver = spec.Basic.Deliver(consumer_tag, delivery_tag, message.redelivered,
+                                         message.exchange, message.routing_key)
+            self.broker._delivered(self.connection)
+            callback(self, deliver, message.properties, message.body)
+            self._schedule_deliveries()
+
+    def _settled(self, delivery_tag, multiple):
+        if not self.is_open:
+            raise exceptions.ChannelClosed()
+        if multiple:
+            tags = [tag for tag in self._unacked if tag <= delivery_tag]
+        else:
+            tags = [delivery_tag] if delivery_tag in self._unacked else []
+        if not tags:
+            # RabbitMQ closes the channel on an unknown delivery tag.
+            self._close(406, 'PRECONDITION_FAILED - unknown delivery tag %s' % delivery_tag)
+        settled = [self._unacked.pop(tag) for tag in tags]
+        self._schedule_deliveries()
+        return settled
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        now = time.time()
+        for _, _, delivered_at in self._settled(delivery_tag, multiple):
+            self.broker.acked += 1
+            self.broker.ack_latency_ms.record((now - delivered_at) * 1000)
+        self.broker.on_settled(self.connection)
+
+    def basic_nack(self, delivery_tag=None, multiple=False, requeue=True):
+        for queue, message, _ in self._settled(delivery_tag, multiple):
+            if requeue:
+                self.broker.requeue(queue, message)
+            else:
+                self.broker.dead_letter(queue, message)
+        self.broker.on_settled(self.connection)
+
+    def basic_reject(self, delivery_tag=None, requeue=True):
+        self.basic_nack(delivery_tag, requeue=requeue)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False, immediate=False):
+        if not self.is_open:
+            raise exceptions.ChannelClosed()
+        self.broker.publish(exchange, routing_key, body, properties, self.connection.ioloop)
+        if self._on_confirm is not None:
+            ack = spec.Basic.Ack(next(self._publish_tags), False)
+            if self.broker.confirm_delay:
+                self.connection.ioloop.add_timeout(self.broker.confirm_delay, partial(self._confirm, ack))
+            else:
+                self._reply(self._on_confirm, ack)
+
+    def _confirm(self, ack):
+        if self.is_open:
+            self._on_confirm(frame.Method(self.channel_number, ack))
+
+    def confirm_delivery(self, callback=None, nowait=False):
+        self._on_confirm = callback
+
+    def close(self, reply_code=0, reply_text='Normal shutdown'):
+        self._close(reply_code, reply_text)
+
+    def _close(self, reply_code, reply_text, notify_now=False):
+        if not self.is_open:
+            return
+        self.is_open = False
+        for consumer_tag in list(self._consumers):
+            self._cancel(consumer_tag)
+        # Unacknowledged messages go back to the front of their queues.
+        for queue, message, _ in reversed(list(self._unacked.values())):
+            self.broker.requeue(queue, message)
+        self._unacked.clear()
+        self.connection._channels.pop(self.channel_number, None)
+        for callback in self._on_close_callbacks:
+            if notify_now:
+                callback(self, reply_code, reply_text)
+            else:
+                self.connection.ioloop.add_callback(partial(callback, self, reply_code, reply_text))
+
+
+def _benchmark_callback(properties, body):
+    roll = random.random()
+    if roll < properties.headers['x-retry-rate']:
+        raise RetryException()
+    if roll < properties.headers['x-retry-rate'] + properties.headers['x-reject-rate']:
+        raise RejectException()
+
+
+class _BenchmarkBroker(FakeBroker):
+    """Stops the IOLoop once every message is settled, and times recoveries."""
+    def __init__(self, **kwargs):
+        super(_BenchmarkBroker, self).__init__(**kwargs)
+        self.recovery_ms = Histogram()
+        self._dropped_at = None
+
+    def connect(self, *args, **kwargs):
+        connection = super(_BenchmarkBroker, self).connect(*args, **kwargs)
+        connection.add_on_close_callback(self._on_connection_closed)
+        return connection
+
+    def _on_connection_closed(self, connection, reply_code, reply_text):
+        if reply_code == 320:
+            self._dropped_at = time.time()
+
+    def _delivered(self, connection):
+        if self._dropped_at is not None:
+            self.recovery_ms.record((time.time() - self._dropped_at) * 1000)
+            self._dropped_at = None
+        super(_BenchmarkBroker, self)._delivered(connection)
+
+    def on_settled(self, connection):
+        # Done once nothing is waiting to be consumed, retried or acknowledged.
+        # Parked messages have neither consumers nor a dead-letter exchange.
+        for queue in self.queues.values():
+            if queue.messages and (queue.consumers or 'x-dead-letter-exchange' in queue.arguments):
+                return
+        for each in self.connections:
+            if any(channel._unacked for channel in each._channels.values()):
+                return
+        connection.ioloop.stop()
+
+
+def benchmark(messages=10000, message_size=256, retry_rate=0.0, reject_rate=0.0, disconnect_every=None,
+              time_scale=0.001, seed=0, **consumer_kwargs):
+    """
+    Consume messages through a Consumer connected to a FakeBroker and measure
+    throughput, ack latency and how long it takes to resume consuming after
+    the broker drops the connection.
+
+    - messages is the number of messages to consume
+    - message_size is the size of each body in bytes
+    - retry_rate and reject_rate are the chances of each callback raising
+      RetryException or RejectException
+    - disconnect_every closes the connection after that many deliveries
+    - time_scale scales every timeout, including the 5 second reconnect delay
+    - consumer_kwargs are passed on to Consumer, e.g. concurrency, workers,
+      prefetch_count or ack_batch_size
+
+    Returns a dict of results. Ack latency is measured by the broker from
+    delivery to acknowledgement, and recovery from the connection being
+    dropped to the next delivery, both in milliseconds.
+    """
+    random.seed(seed)
+    broker = _BenchmarkBroker(time_scale=time_scale, disconnect_every=disconnect_every)
+    broker.declare_queue('benchmark')
+    body = b'x' * message_size
+    properties = pika.BasicProperties(headers={'x-retry-rate': retry_rate, 'x-reject-rate': reject_rate})
+    for _ in range(messages):
+        broker.publish('', 'benchmark', body, properties)
+
+    consumer_kwargs.setdefault('logging', False)
+    if 'on_batch_callback' not in consumer_kwargs:
+        consumer_kwargs.setdefault('on_message_callback', _benchmark_callback)
+    consumer = Consumer('amqp://fake', exchange='benchmark', queue='benchmark', routing_key='benchmark',
+                        connection_class=broker.connect, instrument=True, **consumer_kwargs)
+    started = time.time()
+    consumer.run()
+    seconds = time.time() - started
+    consumer.stop()
+
+    return {
+        'messages': messages,
+        'message_size': message_size,
+        'seconds': seconds,
+        'messages_per_second': messages / seconds,
+        'delivered': broker.delivered,
+        'redelivered': broker.requeued,
+        'rejected': broker.dropped,
+        'disconnects': broker.disconnects,
+        'ack_latency_ms': broker.ack_latency_ms.snapshot(),
+        'recovery_ms': broker.recovery_ms.snapshot(),
+        'consumer': consumer.stats(),
+    }
+
+
+def benchmark_publisher(messages=5000, message_size=256, confirm_windows=(1, 10, 100, 1000), confirm_delay=0.0005):
+    """
+    Publish messages through a Publisher connected to a FakeBroker, once for
+    each of confirm_windows, and measure throughput until every message has
+    been confirmed. A window of 1 waits for each confirm before publishing the
+    next message.
+
+    - confirm_delay is the number of seconds the broker takes to confirm each
+      message, i.e. the round trip to RabbitMQ
+
+    Returns a dict of results per window.
+    """
+    body = b'x' * message_size
+    results = {}
+    for confirm_window in confirm_windows:
+        broker = FakeBroker(confirm_delay=confirm_delay)
+        broker.declare_queue('benchmark')
+        publisher = Publisher('amqp://fake', routing_key='benchmark', logging=False,
+                              confirm_window=confirm_window, connection_class=broker.connect)
+        publisher.start()
+        started = time.time()
+        for _ in range(messages):
+            publisher.publish(body)
+        publisher.wait_for_confirms()
+        seconds = time.time() - started
+        publisher.stop()
+        results[confirm_window] = {
+            'seconds': seconds,
+            'messages_per_second': messages / seconds,
+            'confirmed': publisher.confirmed,
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark rmq.Consumer against an in-process fake broker')
+    parser.add_argument('--publisher', default=False, action='store_true',
+                        help='benchmark rmq.Publisher with increasing confirm windows instead')
+    parser.add_argument('--confirm_delay', type=float, default=0.0005,
+                        help='with --publisher, seconds the broker takes to confirm each message')
+    parser.add_argument('-n', '--messages', type=int, default=10000)
+    parser.add_argument('-s', '--message_size', type=int, default=256)
+    parser.add_argument('--retry_rate', type=float, default=0.0)
+    parser.add_argument('--reject_rate', type=float, default=0.0)
+    parser.add_argument('--disconnect_every', type=int, default=None)
+    parser.add_argument('--concurrency', choices=('thread', 'process'), default=None)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--prefetch_count', type=int, default=None)
+    parser.add_argument('--ack_batch_size', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.publisher:
+        results = benchmark_publisher(args.messages, args.message_size, confirm_delay=args.confirm_delay)
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    results = benchmark(args.messages, args.message_size, args.retry_rate, args.reject_rate, args.disconnect_every,
+                        concurrency=args.concurrency, workers=args.workers,
+                        prefetch_count=args.prefetch_count, ack_batch_size=args.ack_batch_size)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+import os
+import socket
+import threading
+import unittest
+from datetime import date, datetime
+from decimal import Decimal
+
+from flutil import db
+
+
+class CopyValueTest(unittest.TestCase):
+    def test_floats_keep_full_precision(self):
+        for value in (0.1234567890123456, 1e-300, 123456789.123456789, -2.5):
+            self.assertEqual(float(db._copy_value(value)), value)
+
+    def test_json_values(self):
+        self.assertEqual(db._copy_value({'a': [1, 'b\tc']}), '{"a": [1, "b\\\\tc"]}')
+        self.assertEqual(db._copy_value([1, 2]), '[1, 2]')
+
+    def test_other_types(self):
+        self.assertEqual(db._copy_value(None), '\\N')
+        self.assertEqual(db._copy_value(True), 't')
+        self.assertEqual(db._copy_value(u'caf\xe9\n'), 'caf\xc3\xa9\\n')
+        self.assertEqual(db._copy_value(Decimal('1.10')), '1.10')
+        self.assertEqual(db._copy_value(date(2016, 2, 29)), '2016-02-29')
+        self.assertEqual(db._copy_value(bytearray('\x00\xff')), '\\\\x00ff')
+
+    def test_unknown_types_are_rejected(self):
+        self.assertRaises(TypeError, db._copy_value, object())
+
+
+class _Connection(object):
+    # Just enough of a psycopg2 connection for LivenessPolicy.check, failing any round trip.
+    closed = False
+    status = db.psycopg2.extensions.STATUS_READY
+
+    def __init__(self, fd):
+        self._fd = fd
+
+    def fileno(self):
+        return self._fd
+
+    def cursor(self):
+        raise AssertionError('round trip')
+
+
+class LivenessPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.sockets = socket.socketpair()
+        self.info = db.ConnectionInfo(1000)
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+
+    def test_recently_used_connections_skip_the_round_trip(self):
+        con = _Connection(self.sockets[0].fileno())
+        self.assertTrue(db.LivenessPolicy().check(con, self.info, now=1001))
+        self.assertTrue(db.LivenessPolicy(local_check=False).check(con, self.info, now=1001))
+        self.assertRaises(AssertionError, db.LivenessPolicy().check, con, self.info, now=1100)
+
+    def test_readable_socket_needs_a_round_trip(self):
+        self.sockets[1].close()
+        con = _Connection(self.sockets[0].fileno())
+        self.assertRaises(AssertionError, db.LivenessPolicy().check, con, self.info, now=1001)
+
+    def test_descriptors_past_fd_setsize(self):
+        try:
+            fd = os.dup2(self.sockets[0].fileno(), 1500) or 1500
+        except OSError:
+            self.skipTest('cannot open descriptor 1500')
+        try:
+            self.assertTrue(db.LivenessPolicy().check(_Connection(fd), self.info, now=1001))
+        finally:
+            os.close(fd)
+
+
+class StatsTest(unittest.TestCase):
+    def test_stats_of_an_unopened_pool(self):
+        database_pool = db.DatabasePool('postgresql://nobody@127.0.0.1:1/none', maxcount=5,
+                                        replica_urls=['postgresql://nobody@127.0.0.1:1/replica'])
+        stats = database_pool.stats()
+        self.assertIsNone(database_pool._connection_pool)
+        self.assertEqual((stats['in_use'], stats['idle'], stats['max'], stats['checkouts']), (0, 0, 5, 0))
+        self.assertEqual(sum(stats['wait_ms_histogram'].values()), 0)
+        self.assertEqual(len(stats['replicas']), 1)
+
+
+@unittest.skipUnless(os.environ.get('DATABASE_URL'), 'DATABASE_URL is not set')
+class BulkInsertTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = db.DatabasePool(os.environ['DATABASE_URL'], mincount=1, maxcount=1)
+        with self.pool.cursor(commit_on_close=True) as cur:
+            cur.execute('CREATE TABLE flutil_copy_test (f float8, j jsonb, t timestamptz, b bytea)')
+
+    def tearDown(self):
+        with self.pool.cursor(commit_on_close=True) as cur:
+            cur.execute('DROP TABLE flutil_copy_test')
+        self.pool.close()
+
+    def test_round_trip(self):
+        row = (0.1234567890123456, {'a': [1, 'x\ty'], 'b': None},
+               datetime(2016, 5, 1, 12, 30, 15, 123456), bytearray('\x00\\\xff'))
+        self.pool.bulk_insert('flutil_copy_test', ['f', 'j', 't', 'b'], [row])
+        with self.pool.cursor() as cur:
+            cur.execute("SELECT f, j, t AT TIME ZONE current_setting('TimeZone') AS t, b FROM flutil_copy_test")
+            result = cur.fetchone()
+        self.assertEqual(result['f'], row[0])
+        self.assertEqual(result['j'], row[1])
+        self.assertEqual(result['t'], row[2])
+        self.assertEqual(bytearray(result['b']), row[3])
+
+
+@unittest.skipUnless(os.environ.get('DATABASE_URL'), 'DATABASE_URL is not set')
+class PreparedStatementTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = db.DatabasePool(os.environ['DATABASE_URL'], mincount=1, maxcount=1, prepare_threshold=2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def prepared_on_server(self, cur):
+        cur.execute('SELECT count(*) AS count FROM pg_prepared_statements')
+        return cur.fetchone()['count']
+
+    def test_failed_execute_deallocates(self):
+        sql = 'SELECT 1 / %s AS x'
+        self.pool.mark_hot(sql)
+        with self.pool.cursor() as cur:
+            self.pool.execute(cur, sql, (1,))
+            self.assertEqual(self.prepared_on_server(cur), 1)
+            cur.connection.rollback()
+            cur.connection.autocommit = True
+            self.assertRaises(db.psycopg2.DataError, self.pool.execute, cur, sql, (0,))
+            self.assertEqual(self.prepared_on_server(cur), 0)
+            cur.connection.autocommit = False
+
+            # Inside a transaction the failure aborts it, so it waits for the next PREPARE.
+            self.pool.execute(cur, sql, (1,))
+            self.assertRaises(db.psycopg2.DataError, self.pool.execute, cur, sql, (0,))
+            cur.connection.rollback()
+            self.pool.execute(cur, sql, (1,))
+            self.assertEqual(self.prepared_on_server(cur), 1)
+            cur.connection.rollback()
+
+    def test_mark_hot_from_many_threads(self):
+        queries = ['SELECT %d AS x' % i for i in range(200)]
+
+        def run(offset):
+            with self.pool.cursor() as cur:
+                for sql in queries[offset::4]:
+                    self.pool.execute(cur, sql)
+            self.pool.mark_hot(*queries[offset::4])
+
+        self.pool.close()
+        self.pool = db.DatabasePool(os.environ['DATABASE_URL'], mincount=1, maxcount=4, prepare_threshold=2)
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(self.pool._statements[sql].hot for sql in queries))
+
+
+@unittest.skipUnless(os.environ.get('DATABASE_URL'), 'DATABASE_URL is not set')
+class AsyncDatabasePoolTest(unittest.TestCase):
+    def setUp(self):
+        from tornado.ioloop import IOLoop
+        self.ioloop = IOLoop()
+        self.pool = db.AsyncDatabasePool(os.environ['DATABASE_URL'], mincount=0, maxcount=1,
+                                         checkout_timeout=0.05, ioloop=self.ioloop)
+
+    def tearDown(self):
+        self.pool.close()
+        self.ioloop.close(all_fds=True)
+
+    def test_timed_out_checkout_does_not_take_the_connection(self):
+        @db.gen.coroutine
+        def run():
+            con = yield self.pool._acquire()
+            with self.assertRaises(db.PoolTimeoutError):
+                yield self.pool._acquire()
+            self.pool._release(con)
+            self.assertEqual(self.pool._idle, [con])
+            again = yield self.pool._acquire()
+            self.assertIs(again, con)
+            self.pool._release(again)
+        self.ioloop.run_sync(run)
+
+    def test_connection_handed_over_as_the_timeout_fires(self):
+        @db.gen.coroutine
+        def run():
+            con = yield self.pool._acquire()
+            # Release right after the checkout's timeout fires, before the checkout resumes.
+            now = self.ioloop.time()
+            self.ioloop.time = lambda: now
+            try:
+                waiting = self.pool._acquire()
+                self.ioloop.add_timeout(now + 0.05, self.pool._release, con)
+            finally:
+                del self.ioloop.time
+            again = yield waiting
+            self.assertIs(again, con)
+            self.pool._release(again)
+        self.ioloop.run_sync(run)
+
+    def test_busy_connections_are_closed(self):
+        @db.gen.coroutine
+        def run():
+            con = yield self.pool._acquire()
+            con.cursor().execute('SELECT pg_sleep(1)')
+            self.pool._release(con)
+            self.assertTrue(con.closed)
+            self.assertEqual(self.pool._size, 0)
+            rows = yield self.pool.query('SELECT 1 AS one')
+            self.assertEqual(rows, [{'one': 1}])
+        self.ioloop.run_sync(run)
+
+
+if __name__ == '__main__':
+    unittest.main()
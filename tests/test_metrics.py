@@ -0,0 +1,66 @@
+import unittest
+
+from flutil import metrics
+from flutil.metrics import Histogram
+
+try:
+    import flask
+except ImportError:
+    flask = None
+
+
+class HistogramTest(unittest.TestCase):
+    def test_percentiles_within_relative_error(self):
+        histogram = Histogram()
+        for value in range(1, 1001):
+            histogram.record(value)
+        p50, p99 = histogram.percentiles(0.5, 0.99)
+        self.assertAlmostEqual(p50, 500, delta=500 / 16.0)
+        self.assertAlmostEqual(p99, 990, delta=990 / 16.0)
+        self.assertEqual(histogram.percentiles(1.0), [1000])
+
+    def test_zero_sorts_before_small_values(self):
+        histogram = Histogram()
+        for value in [0] * 5 + [0.01] * 5 + [0.2] * 5:
+            histogram.record(value)
+        p25, p50, p90 = histogram.percentiles(0.25, 0.5, 0.9)
+        self.assertEqual(p25, 0)
+        self.assertAlmostEqual(p50, 0.01, delta=0.01 / 16)
+        self.assertAlmostEqual(p90, 0.2, delta=0.2 / 16)
+
+    def test_empty(self):
+        self.assertEqual(Histogram().percentiles(0.5, 0.99), [None, None])
+
+
+@unittest.skipIf(flask is None, 'Flask is not installed')
+class WithMetricsTest(unittest.TestCase):
+    def test_status_of_any_view_return_value(self):
+        app = flask.Flask(__name__)
+
+        @app.route('/string')
+        @metrics.with_metrics
+        def string():
+            return 'hi'
+
+        @app.route('/tuple')
+        @metrics.with_metrics
+        def pair():
+            return 'gone', 410
+
+        @app.route('/response')
+        @metrics.with_metrics
+        def response():
+            return flask.Response('hi', status=201)
+
+        client = app.test_client()
+        self.assertEqual(client.get('/string').status_code, 200)
+        self.assertEqual(client.get('/tuple').status_code, 410)
+        self.assertEqual(client.get('/response').status_code, 201)
+
+        recorded = metrics.snapshot()
+        for name, status_code in (('string', 200), ('pair', 410), ('response', 201)):
+            self.assertEqual(recorded[__name__ + '.' + name][status_code]['count'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
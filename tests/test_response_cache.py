@@ -0,0 +1,51 @@
+import unittest
+
+try:
+    import flask
+    from flutil.response_cache import ResponseCache, cached
+except ImportError:
+    flask = None
+
+
+@unittest.skipIf(flask is None, 'Flask is not installed')
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.app = flask.Flask(__name__)
+        self.response_cache = ResponseCache(self.app)
+        self.calls = 0
+
+        @self.app.before_request
+        def authenticate():
+            if flask.request.headers.get('Authorization') != 'secret':
+                return 'unauthorized', 401
+
+        @self.app.route('/fields')
+        @cached(ttl=60)
+        def fields():
+            self.calls += 1
+            response = flask.Response('fields')
+            response.headers['Vary'] = 'Origin'
+            return response
+
+        self.client = self.app.test_client()
+
+    def test_hits_skip_the_view(self):
+        for _ in range(2):
+            response = self.client.get('/fields', headers={'Authorization': 'secret'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, 'fields')
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.response_cache.stats()['hits'], 1)
+
+    def test_hits_run_before_request_handlers(self):
+        self.client.get('/fields', headers={'Authorization': 'secret'})
+        self.assertEqual(self.client.get('/fields').status_code, 401)
+
+    def test_vary_keeps_the_view_header(self):
+        for _ in range(2):
+            response = self.client.get('/fields', headers={'Authorization': 'secret'})
+            self.assertEqual(sorted(response.vary), ['Accept-Encoding', 'Origin'])
+
+
+if __name__ == '__main__':
+    unittest.main()
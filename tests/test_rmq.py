@@ -0,0 +1,45 @@
+import unittest
+
+from pika import spec
+
+from flutil.rmq import Publisher, PublisherNotRunningException
+from flutil.rmq_testing import FakeBroker
+
+
+class PublisherTest(unittest.TestCase):
+    def setUp(self):
+        self.broker = FakeBroker()
+        self.broker.declare_queue('test')
+
+    def publisher(self, **kwargs):
+        return Publisher('amqp://fake', routing_key='test', logging=False, connection_class=self.broker.connect,
+                         **kwargs)
+
+    def test_publish_after_stop_raises(self):
+        publisher = self.publisher()
+        publisher.start()
+        publisher.publish(b'body')
+        self.assertTrue(publisher.wait_for_confirms(5))
+        publisher.stop()
+        self.assertRaises(PublisherNotRunningException, publisher.publish, b'body')
+        publisher.stop()
+
+    def test_nacked_messages_are_dropped_after_max_republish(self):
+        publisher = self.publisher(max_republish=2)
+        # FakeChannel confirms with whatever spec.Basic.Ack is.
+        ack = spec.Basic.Ack
+        spec.Basic.Ack = spec.Basic.Nack
+        try:
+            publisher.start()
+            publisher.publish(b'body')
+            self.assertTrue(publisher.wait_for_confirms(5))
+        finally:
+            spec.Basic.Ack = ack
+        publisher.stop()
+        self.assertEqual(publisher.published, 3)
+        self.assertEqual(publisher.nacked, 3)
+        self.assertEqual(publisher.dropped, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()